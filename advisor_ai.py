@@ -1,10 +1,193 @@
 import os
+import time
+import asyncio
+import logging
+import statistics
+import json
+from collections import deque
+from contextlib import asynccontextmanager
+import httpx
 from pydantic import BaseModel
 from google import genai
-from google.genai import types
+from google.genai import types, errors
 from typing import List, Optional
+from caching import register
+from chat_history import HistoryManager, HISTORY_SUMMARY_TOKENS
+from image_prep import PreparedImage
+from menu_cache import seconds_until_next_menu_day
+from stream_cache import StreamCache, content_key
+from provider_cache import ProviderContexts, GeminiContextProvider
 import os
 
+logger = logging.getLogger(__name__)
+
+# Upstream generations allowed at once, the rest wait up to GENAI_QUEUE_TIMEOUT seconds
+GENAI_MAX_CONCURRENCY = int(os.getenv("GENAI_MAX_CONCURRENCY", 8))
+GENAI_QUEUE_TIMEOUT = float(os.getenv("GENAI_QUEUE_TIMEOUT", 30))
+
+BUSY_MESSAGE = "The advisor is busy right now, please try again in a minute."
+
+_generation_slots = asyncio.Semaphore(GENAI_MAX_CONCURRENCY)
+
+class AdvisorBusy(Exception):
+    pass
+
+@asynccontextmanager
+async def generation_slot():
+    """Hold one of the GENAI_MAX_CONCURRENCY upstream slots, raising AdvisorBusy if none frees up in time"""
+    try:
+        await asyncio.wait_for(_generation_slots.acquire(), GENAI_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise AdvisorBusy()
+    try:
+        yield
+    finally:
+        _generation_slots.release()
+
+# Pooled, kept-alive connections shared by every request through one client
+GENAI_MAX_CONNECTIONS = int(os.getenv("GENAI_MAX_CONNECTIONS", GENAI_MAX_CONCURRENCY + 2))
+GENAI_KEEPALIVE_EXPIRY = float(os.getenv("GENAI_KEEPALIVE_EXPIRY", 120))
+
+_client = None
+
+def create_genai_client():
+    limits = httpx.Limits(
+        max_connections=GENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=GENAI_MAX_CONNECTIONS,
+        keepalive_expiry=GENAI_KEEPALIVE_EXPIRY,
+    )
+    return genai.Client(
+        api_key=os.getenv("GOOGLE_API_KEY"),
+        http_options=types.HttpOptions(async_client_args={"limits": limits, "http2": True}),
+    )
+
+def get_genai_client():
+    """The process-wide client, created on first use if the app lifespan hasn't made it yet"""
+    global _client
+    if _client is None:
+        _client = create_genai_client()
+    return _client
+
+def start_genai_client():
+    if os.getenv("GOOGLE_API_KEY"):
+        get_genai_client()
+
+def stop_genai_client():
+    global _client
+    _client = None
+
+class GenerationStats:
+    """Queue wait, time to first chunk and prompt size over the last `window` generations"""
+
+    def __init__(self, window=500):
+        self.generations = 0
+        self.queue_wait_ms = deque(maxlen=window)
+        self.first_chunk_ms = deque(maxlen=window)
+        self.prompt_tokens = deque(maxlen=window)
+        self.cached_tokens = deque(maxlen=window)
+
+    def record(self, queue_wait_ms, first_chunk_ms):
+        self.generations += 1
+        self.queue_wait_ms.append(queue_wait_ms)
+        self.first_chunk_ms.append(first_chunk_ms)
+
+    def record_usage(self, prompt_tokens, cached_tokens):
+        self.prompt_tokens.append(prompt_tokens)
+        self.cached_tokens.append(cached_tokens)
+
+    def stats(self):
+        def summary(samples):
+            if not samples:
+                return None
+            ordered = sorted(samples)
+            return {"p50": round(statistics.median(ordered), 1),
+                    "p95": round(ordered[int(len(ordered) * 0.95)], 1)}
+        return {
+            "generations": self.generations,
+            "queue_wait_ms": summary(self.queue_wait_ms),
+            "first_chunk_ms": summary(self.first_chunk_ms),
+            "prompt_tokens": summary(self.prompt_tokens),
+            "cached_tokens": summary(self.cached_tokens),
+        }
+
+generation_stats = register("advisor_generations", GenerationStats())
+
+async def generate_stream(model, contents, config):
+    """Text chunks from the SDK's async stream, holding a generation slot for its whole length"""
+    requested = time.perf_counter()
+    async with generation_slot():
+        started = time.perf_counter()
+        first_chunk = True
+        usage = None
+        async for chunk in await get_genai_client().aio.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=config,
+        ):
+            if first_chunk:
+                first_chunk = False
+                queue_wait_ms = (started - requested) * 1000
+                first_chunk_ms = (time.perf_counter() - started) * 1000
+                generation_stats.record(queue_wait_ms, first_chunk_ms)
+                logger.info("%s first chunk after %.0f ms (queued %.0f ms)", model, first_chunk_ms, queue_wait_ms)
+            if getattr(chunk, "usage_metadata", None) is not None:
+                usage = chunk.usage_metadata
+            if chunk.text:
+                yield chunk.text
+
+    if usage is not None:
+        prompt_tokens = usage.prompt_token_count or 0
+        cached_tokens = usage.cached_content_token_count or 0
+        generation_stats.record_usage(prompt_tokens, cached_tokens)
+        logger.info("%s prompt %d tokens (%d from cached context)", model, prompt_tokens, cached_tokens)
+
+# Meal plans run at temperature 0, so identical prompts share one generation and
+# its replays until the menus they were built from change at midnight
+response_cache = StreamCache(
+    "advisor_responses",
+    maxsize=int(os.getenv("ADVISOR_CACHE_SIZE", 512)),
+    ttl=float(os.getenv("ADVISOR_CACHE_TTL", 24 * 3600)),
+)
+
+def response_ttl():
+    return min(response_cache.ttl, seconds_until_next_menu_day())
+
+# Estimates don't depend on the menus, a re-uploaded photo is answered for a week
+estimate_cache = StreamCache(
+    "advisor_estimates",
+    maxsize=int(os.getenv("ESTIMATE_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("ESTIMATE_CACHE_TTL", 7 * 24 * 3600)),
+)
+
+# Prompt prefixes (system prompt, tools, menu block) registered once with Gemini and then referenced
+provider_contexts = ProviderContexts("provider_contexts", GeminiContextProvider(get_genai_client))
+
+async def generate_with_context(model, prefix, contents, config, ttl=None):
+    """
+    generate_stream for prefix + contents, with prefix and config's system
+    instruction and tools served from a cached context when there is one.
+
+    If the provider has dropped the context before the first chunk, it's
+    forgotten and the prompt is sent in full.
+    """
+    name = await provider_contexts.lookup(model, config, prefix, ttl)
+    if name is not None:
+        cached_config = config.model_copy(update={"cached_content": name, "system_instruction": None, "tools": None})
+        started = False
+        try:
+            async for text in generate_stream(model, contents, cached_config):
+                started = True
+                yield text
+            return
+        except errors.APIError as e:
+            if started:
+                raise
+            logger.warning("Cached context %s unusable, sending the prompt in full: %s", name, e)
+            provider_contexts.expire(model, config, prefix)
+
+    async for text in generate_stream(model, prefix + contents, config):
+        yield text
+
 # Define a model for a single chat message
 class ChatMessage(BaseModel):
     role: str
@@ -12,7 +195,13 @@ class ChatMessage(BaseModel):
 
 class MealPlanRequest(BaseModel):
     user_goal: str
-    food_info: str
+    # Leave food_info out to have the server build it from the menus of `day`,
+    # or just `meal_type` on that day, filtered by the user's plans
+    food_info: Optional[str] = None
+    day: int = 0
+    meal_type: Optional[str] = None
+    # Lets the server reuse the summary of older turns instead of redoing it every turn
+    conversation_id: Optional[str] = None
     # This line makes it optional
     chat_history: Optional[List[ChatMessage]] = None
 
@@ -69,6 +258,10 @@ This is how it should be formatted:
 }}||
 
 If they ask for something impossible, state it in the justification, but do your best to meet their needs. THEY MIGHT WANT MORE THAN ONE MEAL AND HAVE OTHER CONSTRAINTS.
+"""
+
+# Everything above is the same for a whole menu day and gets cached upstream, this is what changes per request
+USER_GOAL_TEMPLATE = """History: {history}
 
 User Goal: {user_goal}
 """
@@ -179,96 +372,237 @@ This is how it should be formatted:
 }||
 """
 
-async def image_stream_generator(image_bytes: bytes):
+# Identical for every request, so they're built once
+IMAGE_MODEL = "gemini-2.5-pro"
+IMAGE_CONFIG = types.GenerateContentConfig(
+    thinking_config = types.ThinkingConfig(
+        thinking_budget=-1,
+    ),
+    tools=[
+        types.Tool(googleSearch=types.GoogleSearch(
+        )),
+    ],
+)
+
+MEAL_PLAN_MODEL = "gemini-2.5-flash"
+MEAL_PLAN_CONFIG = types.GenerateContentConfig(
+    temperature=0,
+    thinking_config = types.ThinkingConfig(
+        thinking_budget=-1,
+    ),
+    tools=[
+        types.Tool(url_context=types.UrlContext()),
+        types.Tool(googleSearch=types.GoogleSearch(
+        )),
+    ],
+    system_instruction=[
+        types.Part.from_text(text=SYSTEM_PROMPT),
+    ],
+)
+
+SUMMARY_PROMPT = """
+You condense a conversation between a student and their Purdue dining court diet advisor. Keep every goal, hard constraint, allergy, preference, food they liked or rejected and plan that was agreed on, and drop everything else. Write plain sentences, no more than a short paragraph.
+"""
+
+SUMMARY_CONFIG = types.GenerateContentConfig(
+    temperature=0,
+    max_output_tokens=HISTORY_SUMMARY_TOKENS,
+    thinking_config = types.ThinkingConfig(
+        thinking_budget=0,
+    ),
+    system_instruction=[
+        types.Part.from_text(text=SUMMARY_PROMPT),
+    ],
+)
+
+async def summarize_turns(summary, transcript):
+    """Fold transcript into the running summary of a conversation"""
+    text = transcript if summary is None else f"Summary so far:\n{summary}\n\nNewer messages:\n{transcript}"
+    async with generation_slot():
+        response = await get_genai_client().aio.models.generate_content(
+            model=MEAL_PLAN_MODEL,
+            contents=text,
+            config=SUMMARY_CONFIG,
+        )
+    if not response.text:
+        raise ValueError("empty summary")
+    return response.text.strip()
+
+history_manager = HistoryManager(summarize_turns)
+
+async def image_stream_generator(image: PreparedImage):
     api_key = os.getenv("GOOGLE_API_KEY")
     if not api_key:
         yield "Error: GOOGLE_API_KEY not configured on the server."
         return
 
-    client = genai.Client(api_key=api_key)
-
-    model = "gemini-2.5-pro"
     contents = [
         types.Content(
             role="user",
             parts=[
                 types.Part.from_bytes(
-                    data=image_bytes,
-                    mime_type='image/jpeg',
+                    data=image.data,
+                    mime_type=image.mime_type,
                 ),
                 types.Part.from_text(text=IMAGE_PROMPT_TEMPLATE),
 
             ],
         ),
     ]
-    tools = [
-        types.Tool(googleSearch=types.GoogleSearch(
-        )),
-    ]
-    generate_content_config = types.GenerateContentConfig(
-        thinking_config = types.ThinkingConfig(
-            thinking_budget=-1,
-        ),
-        tools=tools,
-    )
 
-    for chunk in client.models.generate_content_stream(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-    ):
-        yield chunk.text
-        print(chunk.text, end="")
+    try:
+        key = content_key(IMAGE_MODEL, IMAGE_PROMPT_TEMPLATE, image.digest)
+        async for text in estimate_cache.stream(key, lambda: generate_stream(IMAGE_MODEL, contents, IMAGE_CONFIG)):
+            yield text
+            print(text, end="")
+    except AdvisorBusy:
+        yield BUSY_MESSAGE
 
 
-async def stream_generator(user_goal: str, food_info: str, chat_history: Optional[List[ChatMessage]] = None):
+async def stream_generator(user_goal: str, food_info: str, chat_history: Optional[List[ChatMessage]] = None,
+                           conversation_id: Optional[str] = None):
     """
     Generates a meal plan stream based on user goals and food information.
     """
 
-    history = ""
-    for x in chat_history:
-        f'Role: {x.role}\nText: {x.text}\n\n'
-    
-    try:
-        client = genai.Client(
-            api_key=os.getenv("GOOGLE_API_KEY"),
-        )
+    async def generate(ttl):
+        # Only on a cache miss, a hit mustn't cost a summarizer call either
+        history = await history_manager.render(chat_history, conversation_id)
 
-        model = "gemini-2.5-flash"
-        contents = [
+        prefix = [
             types.Content(
                 role="user",
                 parts=[
-                    types.Part.from_text(text=f"History: {history}\n\n" + USER_INSTRUCTIONS_TEMPLATE.format(
-                    food_info=food_info, user_goal=user_goal
-                )),
+                    types.Part.from_text(text=USER_INSTRUCTIONS_TEMPLATE.format(food_info=food_info)),
                 ],
             ),
         ]
-        tools = [
-            types.Tool(url_context=types.UrlContext()),
-            types.Tool(googleSearch=types.GoogleSearch(
-            )),
-        ]
-        generate_content_config = types.GenerateContentConfig(
-            temperature=0,
-            thinking_config = types.ThinkingConfig(
-                thinking_budget=-1,
+        contents = [
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_text(text=USER_GOAL_TEMPLATE.format(history=history, user_goal=user_goal)),
+                ],
             ),
-            tools=tools,
-            system_instruction=[
-                types.Part.from_text(text=SYSTEM_PROMPT),
-            ],
-        )
+        ]
+        async for text in generate_with_context(MEAL_PLAN_MODEL, prefix, contents, MEAL_PLAN_CONFIG, ttl):
+            yield text
 
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            yield chunk.text
-            print(chunk.text, end="")
+    try:
+        key = content_key(MEAL_PLAN_MODEL, SYSTEM_PROMPT, user_goal, food_info,
+                          [(x.role, x.text) for x in chat_history or []])
+        ttl = response_ttl()
+        async for text in response_cache.stream(key, lambda: generate(ttl), ttl):
+            yield text
+            print(text, end="")
+    except AdvisorBusy:
+        yield BUSY_MESSAGE
     except Exception as e:
         error_message = f"An error occurred while generating the meal plan: {str(e)}"
         yield error_message
+
+# Both prompts ask for the final JSON between these
+PLAN_DELIMITER = "||"
+
+class PlanExtractor:
+    """
+    Splits streamed advisor text into reasoning text and the ||JSON|| plan block as it arrives.
+
+    feed() returns ("text", str) events for text outside the block straight
+    away, and one ("plan", dict) event as soon as the closing delimiter is
+    seen, or ("plan_error", raw text) if the block isn't a JSON object. A
+    trailing "|" is held back until the next chunk shows whether it starts a
+    delimiter.
+    """
+
+    def __init__(self):
+        self.pending = ""
+        self.block = None
+
+    def feed(self, text):
+        events = []
+        data = self.pending + text
+        self.pending = ""
+        while data:
+            if data.endswith("|") and not data.endswith(PLAN_DELIMITER):
+                self.pending = "|"
+                data = data[:-1]
+
+            found = data.find(PLAN_DELIMITER)
+            if self.block is None:
+                if found == -1:
+                    if data:
+                        events.append(("text", data))
+                    break
+                if found:
+                    events.append(("text", data[:found]))
+                self.block = ""
+            else:
+                if found == -1:
+                    self.block += data
+                    break
+                self.block += data[:found]
+                events.append(self.close_block())
+            data = data[found + len(PLAN_DELIMITER):]
+        return events
+
+    def close_block(self):
+        raw, self.block = self.block, None
+        body = raw.strip()
+        if body.startswith("```"):
+            body = body.split("\n", 1)[1] if "\n" in body else ""
+            body = body.rsplit("```", 1)[0]
+        try:
+            plan = json.loads(body)
+        except ValueError:
+            return ("plan_error", raw)
+        if not isinstance(plan, dict):
+            return ("plan_error", raw)
+        return ("plan", plan)
+
+    def finish(self):
+        """Events for whatever is left once the stream ends, an unclosed block goes out as plain text"""
+        if self.block is not None:
+            text, self.block = PLAN_DELIMITER + self.block + self.pending, None
+        else:
+            text = self.pending
+        self.pending = ""
+        return [("text", text)] if text else []
+
+STREAM_MEDIA_TYPES = {
+    "text": "text/plain",
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+# Field each event type carries its value in
+EVENT_FIELDS = {"text": "text", "plan": "plan", "plan_error": "raw"}
+
+def encode_event(kind, value, stream_format):
+    payload = {"type": kind, EVENT_FIELDS[kind]: value}
+    if stream_format == "sse":
+        return f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+    return json.dumps(payload) + "\n"
+
+async def event_stream(chunks, stream_format="text"):
+    """
+    Re-encode an advisor text stream in stream_format.
+
+    "text" passes it through untouched, "ndjson" and "sse" send text, plan
+    and plan_error events from PlanExtractor followed by a done event.
+    """
+    if stream_format == "text":
+        async for text in chunks:
+            yield text
+        return
+
+    extractor = PlanExtractor()
+    async for text in chunks:
+        for kind, value in extractor.feed(text):
+            yield encode_event(kind, value, stream_format)
+    for kind, value in extractor.finish():
+        yield encode_event(kind, value, stream_format)
+    if stream_format == "sse":
+        yield "event: done\ndata: {}\n\n"
+    else:
+        yield json.dumps({"type": "done"}) + "\n"
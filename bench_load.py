@@ -0,0 +1,69 @@
+"""
+Load test for event loop responsiveness under slow database work.
+
+Keeps `--concurrency` cold /recommend_mean requests in flight (each one
+invalidates the menu cache first so it has to hit Postgres) and meanwhile
+measures latency of cheap requests that never touch the database. With a
+blocking DB layer the cheap requests' p99 tracks the slowest query, with the
+async layer it stays flat.
+
+    ADMIN_TOKEN=... python bench_load.py http://127.0.0.1:8000 --concurrency 20 --seconds 30
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+def percentile(samples, q):
+    if not samples:
+        return float("nan")
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def report(name, samples):
+    print(f"{name:22} n={len(samples):6}  p50 {percentile(samples, 0.5):8.1f} ms"
+          f"  p99 {percentile(samples, 0.99):8.1f} ms  max {max(samples, default=float('nan')):8.1f} ms")
+
+async def slow_worker(client, admin_token, stop, latencies, day):
+    while time.monotonic() < stop:
+        await client.post("/menus/invalidate", headers={"x-admin-token": admin_token})
+        start = time.perf_counter()
+        await client.post("/recommend_mean", json={"day": day, "hall": "", "meal_type": "dinner"})
+        latencies.append((time.perf_counter() - start) * 1000)
+
+async def probe(client, stop, latencies):
+    while time.monotonic() < stop:
+        start = time.perf_counter()
+        await client.get("/cache_stats")
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.01)
+
+async def main(args):
+    admin_token = os.environ["ADMIN_TOKEN"]
+    limits = httpx.Limits(max_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        # One user shared by every worker, with targets so the optimizer has work to do
+        await client.get("/register")
+        await client.post("/update_user_macs", json={"protein": 150, "carbs": 250, "fat": 70, "cals": 2400})
+
+        stop = time.monotonic() + args.seconds
+        slow, fast = [], []
+        await asyncio.gather(
+            *(slow_worker(client, admin_token, stop, slow, i % 7) for i in range(args.concurrency)),
+            probe(client, stop, fast),
+        )
+
+    report("/recommend_mean cold", slow)
+    report("/cache_stats", fast)
+    if fast:
+        print(f"/cache_stats mean {statistics.mean(fast):.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=30)
+    asyncio.run(main(parser.parse_args()))
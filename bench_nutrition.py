@@ -0,0 +1,120 @@
+"""
+Micro-benchmark for the nutrition decoder.
+
+Compares the original char-by-char splitter with optimize.parse_nutrition on
+real-shaped Food.nutrition blobs, and checks both produce identical FoodItems.
+
+    python bench_nutrition.py [count]
+"""
+import json
+import random
+import sys
+import time
+
+from optimize import create_food_item, food_item_from_facts, cached_nutrition
+
+LABELS = [
+    ("Serving Size", None), ("Calories", 600), ("Calories from fat", 300),
+    ("Total fat", 40), ("Saturated fat", 15), ("Trans fat", 2),
+    ("Cholesterol", 300), ("Sodium", 1500), ("Total Carbohydrate", 90),
+    ("Sugar", 40), ("Added Sugar", 25), ("Dietary Fiber", 12),
+    ("Protein", 60), ("Calcium", 400), ("Iron", 8),
+]
+
+def make_blob(rng):
+    facts = []
+    for order, (name, top) in enumerate(LABELS, start=1):
+        if top is None:
+            value, label = None, f"{rng.randint(1, 3)} cup"
+        else:
+            value = round(rng.uniform(0, top), 4)
+            label = f"{value:g}"
+        facts.append({"name": name, "value": value, "label": label,
+                      "dailyValue": None if rng.random() < 0.5 else f"{rng.randint(0, 60)}%",
+                      "order": order})
+    elements = ['"' + json.dumps(fact, separators=(',', ':')).replace('"', '\\"') + '"' for fact in facts]
+    return "{" + ",".join(elements) + "}"
+
+def legacy_create_food_item(name, nutrition_data):
+    """The original create_food_item, kept here as the reference implementation"""
+    data_str = str(nutrition_data)
+    if data_str.startswith('{') and data_str.endswith('}'):
+        data_str = data_str[1:-1]
+        json_parts = []
+        current_part = ""
+        in_quotes = False
+        escape_next = False
+        for char in data_str:
+            if escape_next:
+                current_part += char
+                escape_next = False
+            elif char == '\\':
+                escape_next = True
+                current_part += char
+            elif char == '"' and not escape_next:
+                in_quotes = not in_quotes
+                current_part += char
+            elif char == ',' and not in_quotes:
+                if current_part.strip():
+                    clean_part = current_part.strip().strip('"').replace('\\"', '"')
+                    json_parts.append(clean_part)
+                current_part = ""
+            else:
+                current_part += char
+        if current_part.strip():
+            clean_part = current_part.strip().strip('"').replace('\\"', '"')
+            json_parts.append(clean_part)
+    else:
+        json_parts = [data_str]
+
+    calories = fat = carbs = protein = 0
+    for json_str in json_parts:
+        try:
+            fact = json.loads(json_str)
+            name_field = fact.get('name', '').lower()
+            value = fact.get('value')
+            if value is not None:
+                if 'calories' in name_field and 'from fat' not in name_field:
+                    calories = value
+                elif 'total fat' in name_field:
+                    fat = value
+                elif 'total carbohydrate' in name_field:
+                    carbs = value
+                elif name_field == 'protein':
+                    protein = value
+        except json.JSONDecodeError:
+            continue
+
+    return (name, round(protein, 1), round(carbs, 1), round(fat, 1), int(calories))
+
+def as_tuple(item):
+    return (item.name, item.protein, item.carbs, item.fat, item.cals)
+
+def timed(fn, blobs):
+    start = time.perf_counter()
+    results = [fn(f"food {i}", blob) for i, blob in enumerate(blobs)]
+    return results, time.perf_counter() - start
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rng = random.Random(42)
+    blobs = [make_blob(rng) for _ in range(count)]
+    # Odd shapes the fallback paths have to agree on too
+    blobs += ["{}", "None", "{not json}", blobs[0][:-1] + ',"{broken"}']
+
+    legacy, legacy_time = timed(legacy_create_food_item, blobs)
+    current, current_time = timed(lambda name, blob: as_tuple(create_food_item(name, blob)), blobs)
+    assert legacy == current, "decoders disagree"
+
+    # Simulate the same foods showing up on many menus
+    menus = 5
+    start = time.perf_counter()
+    for _ in range(menus):
+        for i, blob in enumerate(blobs):
+            food_item_from_facts(f"food {i}", cached_nutrition(f"id-{i}", blob))
+    cached_time = (time.perf_counter() - start) / menus
+
+    print(f"{len(blobs)} blobs, identical FoodItems")
+    print(f"legacy splitter   {legacy_time * 1000:8.1f} ms")
+    print(f"single-pass       {current_time * 1000:8.1f} ms  ({legacy_time / current_time:.1f}x)")
+    print(f"cached, per menu  {cached_time * 1000:8.1f} ms  ({legacy_time / cached_time:.1f}x)")
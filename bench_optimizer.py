@@ -0,0 +1,104 @@
+"""
+Benchmark for the optimizer engines.
+
+Runs the greedy and balanced optimizers with the pure Python and NumPy engines
+on synthetic menus of 50 to 5,000 items, checking every engine picks exactly
+the same foods. "matrix" is the NumPy engine fed a prebuilt MacroMatrix, the
+way menu snapshots hand it menus.
+
+Also checks that prune_duplicates leaves every optimizer's answer unchanged
+on menus full of repeated portion variants, and times the exact optimizer
+with and without it.
+
+    python bench_optimizer.py [repeats]
+"""
+import random
+import sys
+import time
+
+from optimize import (FoodItem, MacroMatrix, calculate_distance, prune_duplicates,
+                      find_optimal_foods_greedy, find_optimal_foods_balanced, find_optimal_foods_exact)
+
+SIZES = (50, 200, 1000, 5000)
+
+def make_food(rng, i):
+    kind = rng.random()
+    if kind < 0.3:
+        # Mains
+        return FoodItem(f"main {i}", round(rng.uniform(10, 45), 1), round(rng.uniform(5, 70), 1),
+                        round(rng.uniform(3, 35), 1), rng.randint(200, 800))
+    if kind < 0.55:
+        # Vegetables
+        return FoodItem(f"veg {i}", round(rng.uniform(0, 4), 1), round(rng.uniform(0, 15), 1),
+                        round(rng.uniform(0, 2), 1), rng.randint(0, 50))
+    return FoodItem(f"side {i}", round(rng.uniform(0, 12), 1), round(rng.uniform(5, 60), 1),
+                    round(rng.uniform(0, 20), 1), rng.randint(60, 400))
+
+def make_targets(rng):
+    return (rng.uniform(20, 70), rng.uniform(40, 120), rng.uniform(10, 40), rng.uniform(400, 1100))
+
+def run(optimizer, engine, cases):
+    start = time.perf_counter()
+    results = [optimizer(*targets, foods, engine=engine) for targets, foods in cases]
+    return results, time.perf_counter() - start
+
+def same(a, b):
+    return [id(food) for food in a[0]] == [id(food) for food in b[0]] and a[1] == b[1]
+
+def check_pruning(rng, repeats):
+    for size in (12, 40, 200):
+        shrink = 0
+        full_time = pruned_time = 0
+        for _ in range(repeats):
+            base = [make_food(rng, i) for i in range(size // 4)]
+            # Every dish served in several identical portions across stations
+            foods = [FoodItem(f"{food.name} #{copy}", food.protein, food.carbs, food.fat, food.cals)
+                     for food in base for copy in range(rng.randint(1, 8))]
+            rng.shuffle(foods)
+            pruned = MacroMatrix(foods).subset(prune_duplicates(foods))
+            shrink += 1 - len(pruned) / len(foods)
+            targets = make_targets(rng)
+
+            for optimizer in (find_optimal_foods_greedy, find_optimal_foods_balanced):
+                assert same(optimizer(*targets, foods), optimizer(*targets, pruned)), f"pruning changed {optimizer.__name__}"
+
+            deadline = 60000 if size <= 40 else 250
+            start = time.perf_counter()
+            full = find_optimal_foods_exact(*targets, foods, deadline_ms=deadline)
+            full_time += time.perf_counter() - start
+            start = time.perf_counter()
+            reduced = find_optimal_foods_exact(*targets, pruned, deadline_ms=deadline)
+            pruned_time += time.perf_counter() - start
+            if size <= 40:
+                assert calculate_distance(*targets, *full[1]) == calculate_distance(*targets, *reduced[1]), "pruning changed exact"
+
+        print(f"prune_duplicates ~n={size:5}  shrank {shrink / repeats:5.1%}  exact {full_time / repeats * 1000:7.2f} ms"
+              f" -> {pruned_time / repeats * 1000:7.2f} ms")
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rng = random.Random(7)
+
+    for size in SIZES:
+        cases = []
+        for _ in range(repeats):
+            foods = [make_food(rng, i) for i in range(size)]
+            # Portion variants and sauces exercise tie breaking and the Sauce filter
+            for food in rng.sample(foods, size // 10):
+                foods.append(FoodItem(food.name + " Sauce" if rng.random() < 0.3 else food.name + " (large)",
+                                      food.protein, food.carbs, food.fat, food.cals))
+            cases.append((make_targets(rng), foods))
+        matrix_cases = [(targets, MacroMatrix(foods)) for targets, foods in cases]
+
+        for optimizer in (find_optimal_foods_greedy, find_optimal_foods_balanced):
+            python, python_time = run(optimizer, "python", cases)
+            vectorized, numpy_time = run(optimizer, "numpy", cases)
+            prebuilt, matrix_time = run(optimizer, "numpy", matrix_cases)
+            assert all(same(a, b) for a, b in zip(python, vectorized)), f"{optimizer.__name__} engines disagree"
+            assert all(same(a, b) for a, b in zip(python, prebuilt)), f"{optimizer.__name__} engines disagree"
+
+            print(f"{optimizer.__name__:30} n={size:5}  python {python_time / repeats * 1000:7.2f} ms"
+                  f"  numpy {numpy_time / repeats * 1000:7.2f} ms ({python_time / numpy_time:4.1f}x)"
+                  f"  matrix {matrix_time / repeats * 1000:7.2f} ms ({python_time / matrix_time:4.1f}x)")
+
+    check_pruning(rng, repeats)
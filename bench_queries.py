@@ -0,0 +1,138 @@
+"""
+Query-plan benchmark for the menu indexes.
+
+Loads a semester of synthetic menus into a scratch Postgres database, then
+records EXPLAIN ANALYZE timings for the recommendation queries without and
+with the indexes declared in schema.py.
+
+    BENCH_DB=postgresql://localhost/food_bench python bench_queries.py [days] [items per meal]
+
+BENCH_DB must point at a throwaway database, the foods and menus tables in it
+are dropped and recreated.
+"""
+import datetime
+import json
+import os
+import statistics
+import sys
+
+from sqlalchemy import bindparam, create_engine, text
+
+import schema
+from menu_cache import DINING_HALLS
+
+FOODS = 6000
+REPEATS = 7
+START = datetime.date(2025, 8, 25)
+
+LOAD_FOODS = text("""
+INSERT INTO foods (id, name, nutrition, traits, calories, protein, carbs, fat, nutrition_hash)
+SELECT id, name, nutrition, traits, calories, protein, carbs, fat, md5(nutrition) FROM (
+SELECT 'food-' || g AS id, 'Food ' || g AS name, '{"{\\"name\\":\\"Calories\\",\\"value\\"\\:100}"}' AS nutrition,
+       (ARRAY['Vegan','Vegetarian','Milk','Eggs','Soy','Gluten','Fish','Shellfish','Peanuts'])[1 + g % 9 : 1 + g % 9 + g % 3] AS traits,
+       random() * 800 AS calories, random() * 40 AS protein, random() * 90 AS carbs, random() * 30 AS fat
+FROM generate_series(1, :foods) g
+) generated
+""")
+
+LOAD_MENUS = text("""
+INSERT INTO menus (location, date, item_id, start_time, end_time)
+SELECT hall, to_char(day, 'YYYY-MM-DD'), 'food-' || (1 + floor(random() * :foods))::int,
+       day + meal.opens, day + meal.closes
+FROM generate_series(CAST(:start AS date), CAST(:start AS date) + :days - 1, interval '1 day') day
+CROSS JOIN unnest(CAST(:halls AS varchar[])) hall
+CROSS JOIN (VALUES (interval '7 hours', interval '10 hours'),
+                   (interval '10 hours 30 minutes', interval '14 hours'),
+                   (interval '17 hours', interval '21 hours')) meal(opens, closes)
+CROSS JOIN generate_series(1, :items) item
+""")
+
+# Mirrors menu_cache.menu_statement
+SNAPSHOT_QUERY = text("""EXPLAIN (ANALYZE, FORMAT JSON)
+SELECT foods.id, foods.name, foods.traits, foods.calories, foods.protein, foods.carbs, foods.fat,
+       CASE WHEN foods.calories IS NOT NULL AND foods.nutrition_hash = md5(foods.nutrition)
+            THEN NULL ELSE foods.nutrition END AS stale_nutrition,
+       menus.location
+FROM foods JOIN menus ON foods.id = menus.item_id
+WHERE foods.nutrition != '{}'
+  AND menus.start_time <= :target_time AND menus.end_time >= :target_time
+  AND menus.location IN :halls
+""").bindparams(bindparam("halls", expanding=True))
+
+TRAITS_QUERY = text("""EXPLAIN (ANALYZE, FORMAT JSON)
+SELECT id FROM foods WHERE traits @> CAST(:traits AS varchar[])
+""")
+
+def explain(conn, query, params):
+    """Median execution time in ms and the scan nodes used, over REPEATS runs"""
+    times = []
+    node = None
+    for _ in range(REPEATS):
+        plan = conn.execute(query, params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        times.append(plan[0]["Execution Time"])
+        node = describe(plan[0]["Plan"])
+    return statistics.median(times), node
+
+def describe(plan):
+    """Comma separated scan nodes in a plan, so the index usage is visible"""
+    nodes = []
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        if "Scan" in node["Node Type"]:
+            nodes.append(f"{node['Node Type']} on {node.get('Relation Name')}"
+                         + (f" using {node['Index Name']}" if "Index Name" in node else ""))
+        stack.extend(node.get("Plans", []))
+    return ", ".join(nodes)
+
+def run_queries(conn, days):
+    middle = datetime.datetime.combine(START + datetime.timedelta(days=days // 2), datetime.time(18))
+    cases = {
+        "/recommend one hall": (SNAPSHOT_QUERY, {"target_time": middle, "halls": ["Ford"]}),
+        "/recommend_mean all halls": (SNAPSHOT_QUERY, {"target_time": middle, "halls": list(DINING_HALLS)}),
+        "traits @> {Vegan}": (TRAITS_QUERY, {"traits": ["Vegan"]}),
+    }
+    return {name: explain(conn, query, params) for name, (query, params) in cases.items()}
+
+if __name__ == "__main__":
+    if not os.getenv("BENCH_DB"):
+        sys.exit("Set BENCH_DB to a scratch Postgres database, its foods and menus tables get dropped")
+
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 112
+    items = int(sys.argv[2]) if len(sys.argv) > 2 else 150
+    engine = create_engine(os.environ["BENCH_DB"])
+    tables = [schema.Food.__table__, schema.Menu.__table__]
+    indexes = [index for table in tables for index in table.indexes]
+
+    schema.Base.metadata.drop_all(engine, tables=tables)
+    schema.Base.metadata.create_all(engine, tables=tables)
+    with engine.begin() as conn:
+        for index in indexes:
+            index.drop(bind=conn)
+        conn.execute(LOAD_FOODS, {"foods": FOODS})
+        conn.execute(LOAD_MENUS, {"foods": FOODS, "start": START, "days": days,
+                                  "halls": list(DINING_HALLS), "items": items})
+        conn.execute(text("ANALYZE foods"))
+        conn.execute(text("ANALYZE menus"))
+        rows = conn.execute(text("SELECT count(*) FROM menus")).scalar()
+    print(f"Loaded {FOODS} foods and {rows} menu rows ({days} days)")
+
+    with engine.connect() as conn:
+        before = run_queries(conn, days)
+
+    with engine.begin() as conn:
+        for index in indexes:
+            index.create(bind=conn)
+        conn.execute(text("ANALYZE foods"))
+        conn.execute(text("ANALYZE menus"))
+
+    with engine.connect() as conn:
+        after = run_queries(conn, days)
+
+    for name in before:
+        (before_ms, before_plan), (after_ms, after_plan) = before[name], after[name]
+        print(f"{name:28} {before_ms:9.2f} ms -> {after_ms:9.2f} ms ({before_ms / max(after_ms, 1e-3):.1f}x)")
+        print(f"    before: {before_plan}")
+        print(f"    after:  {after_plan}")
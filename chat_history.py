@@ -0,0 +1,100 @@
+import logging
+import os
+
+from caching import TTLCache
+from menu_context import CHARS_PER_TOKEN
+from stream_cache import content_key
+
+logger = logging.getLogger(__name__)
+
+# Prompt space for history: the rolling summary plus the turns kept word for word
+HISTORY_TOKENS = int(os.getenv("HISTORY_TOKENS", 3000))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", 500))
+
+def format_turn(message):
+    return f"Role: {message.role}\nText: {message.text}\n\n"
+
+class FoldedHistory:
+    """Summary of a conversation's first `count` turns, and a digest of those turns to check it still applies"""
+
+    def __init__(self, count, digest, summary):
+        self.count = count
+        self.digest = digest
+        self.summary = summary
+
+def turns_digest(turns):
+    return content_key([(message.role, message.text) for message in turns])
+
+class HistoryManager:
+    """
+    Fits chat history into HISTORY_TOKENS: recent turns verbatim, older ones folded into a summary.
+
+    Once the verbatim turns outgrow their share, the oldest are folded until
+    what's left fits in half of it, so a fold happens every few turns rather
+    than every turn. The summary is cached per conversation and extended with
+    only the newly folded turns, as long as the turns it was built from are
+    still the start of the history the client sends.
+    """
+
+    def __init__(self, summarize, max_tokens=None, summary_tokens=None):
+        """
+        Args:
+            summarize: async (previous summary or None, transcript of the turns to fold) -> new summary
+        """
+        self.summarize = summarize
+        self.max_tokens = HISTORY_TOKENS if max_tokens is None else max_tokens
+        self.summary_tokens = HISTORY_SUMMARY_TOKENS if summary_tokens is None else summary_tokens
+        self.summaries = TTLCache(
+            "conversation_summaries",
+            maxsize=int(os.getenv("HISTORY_CACHE_SIZE", 2048)),
+            ttl=float(os.getenv("HISTORY_CACHE_TTL", 24 * 3600)),
+        )
+
+    def verbatim_budget(self):
+        return (self.max_tokens - self.summary_tokens) * CHARS_PER_TOKEN
+
+    def fold_point(self, turns, start):
+        """Index to fold up to so the turns after it fit in half the verbatim budget. The last turn is never folded"""
+        end = len(turns) - 1
+        size = len(format_turn(turns[end]))
+        while end > start and size + len(format_turn(turns[end - 1])) <= self.verbatim_budget() // 2:
+            end -= 1
+            size += len(format_turn(turns[end]))
+        return end
+
+    async def render(self, turns, conversation_id=None):
+        """Prompt text for the history: the summary of folded turns, then the rest verbatim"""
+        turns = list(turns or [])
+        if not turns:
+            return ""
+
+        key = conversation_id or turns_digest(turns[:1])
+        folded = self.summaries.get(key)
+        if folded is not None and (folded.count > len(turns) or turns_digest(turns[:folded.count]) != folded.digest):
+            folded = None
+        start = folded.count if folded is not None else 0
+
+        end = start
+        if sum(len(format_turn(message)) for message in turns[start:]) > self.verbatim_budget():
+            end = self.fold_point(turns, start)
+        if end > start:
+            transcript = "".join(format_turn(message) for message in turns[start:end])
+            previous = folded.summary if folded is not None else None
+            try:
+                summary = await self.summarize(previous, transcript)
+                folded = FoldedHistory(end, turns_digest(turns[:end]), summary)
+                self.summaries.set(key, folded)
+            except Exception as e:
+                # Not cached, the next turn tries to summarize again
+                logger.warning("Summarizing chat history failed, clipping instead: %s", e)
+                clipped = ((previous or "") + "\n" + transcript)[-self.summary_tokens * CHARS_PER_TOKEN:]
+                folded = FoldedHistory(end, None, clipped)
+            start = end
+
+        verbatim = "".join(format_turn(message) for message in turns[start:])
+        if len(verbatim) > self.verbatim_budget():
+            # A single huge turn, keep its end
+            verbatim = verbatim[-self.verbatim_budget():]
+        if folded is None:
+            return verbatim
+        return f"Summary of the earlier conversation:\n{folded.summary}\n\nMost recent messages:\n{verbatim}"
@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+
+from sqlalchemy import select
+
+import schema
+from caching import TTLCache, register
+from menu_cache import menu_version
+from optimize import FoodItem
+from traits import compile_plans
+
+logger = logging.getLogger(__name__)
+
+# Width of a target bucket in daily (protein g, carbs g, fat g, kcal). Users
+# whose targets round to the same bucket share its precomputed cells, which are
+# solved for the bucket's center, a few grams or kcal per meal away at most
+GRID_STEPS = tuple(float(step) for step in os.getenv("GRID_STEPS", "5,10,5,50").split(","))
+
+# Cells for a meal, loaded from recommendation_grid once per menu version
+grid_cache = TTLCache(
+    "recommendation_grid",
+    maxsize=int(os.getenv("GRID_CACHE_SIZE", 64)),
+    ttl=float(os.getenv("MENU_CACHE_TTL", 3600)),
+)
+
+# How long a meal whose grid couldn't be loaded is treated as having none before trying again
+GRID_RETRY = float(os.getenv("GRID_RETRY", 300))
+
+class GridStats:
+    """Hall lookups answered from the grid vs left to a live solve"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+grid_stats = register("grid_lookups", GridStats())
+
+def target_bucket(protein, carbs, fat, cals):
+    """Center of the GRID_STEPS bucket holding these daily targets"""
+    return tuple(round(value / step) * step for value, step in zip((protein, carbs, fat, cals), GRID_STEPS))
+
+def cell_key(hall, optimizer, include, exclude, bucket):
+    return (hall, optimizer, include, exclude, tuple(float(value) for value in bucket))
+
+def encode_result(selected, totals):
+    return json.dumps({
+        "foods": [[food.name, food.protein, food.carbs, food.fat, food.cals] for food in selected],
+        "totals": list(totals),
+    })
+
+def decode_result(result):
+    data = json.loads(result)
+    return [FoodItem(*food) for food in data["foods"]], tuple(data["totals"])
+
+async def load_grids(db, target_times):
+    """{target_time: {cell_key: (selected, totals)}} for every cell precomputed for the target times"""
+    grids = {target_time: {} for target_time in target_times}
+    rows = (await db.execute(
+        select(schema.GridCell).where(schema.GridCell.target_time.in_(list(grids)))
+    )).scalars().all()
+    for row in rows:
+        key = cell_key(row.hall, row.optimizer, row.include_mask, row.exclude_mask,
+                       (row.protein, row.carbs, row.fat, row.cals))
+        grids[row.target_time][key] = decode_result(row.result)
+    return grids
+
+async def get_grids(db, target_times):
+    """Cells by target time, loading the ones not already cached with one query"""
+    version = menu_version()
+    grids = {}
+    missing = []
+    for target_time in target_times:
+        cells = grid_cache.get((target_time, version))
+        if cells is None:
+            missing.append(target_time)
+        else:
+            grids[target_time] = cells
+
+    if missing:
+        try:
+            loaded = await load_grids(db, missing)
+        except Exception as e:
+            # The grid only saves solves, without it (table not created yet, DB hiccup) everything is solved live.
+            # Remembered as empty for GRID_RETRY so every request doesn't rerun the failing query
+            logger.warning("Loading the recommendation grid failed, solving live for %ss: %s", GRID_RETRY, e)
+            await db.rollback()
+            for target_time in missing:
+                grid_cache.set((target_time, version), {}, GRID_RETRY)
+                grids[target_time] = {}
+            return grids
+        for target_time, cells in loaded.items():
+            grid_cache.set((target_time, version), cells)
+            grids[target_time] = cells
+    return grids
+
+async def get_grid(db, target_time):
+    return (await get_grids(db, [target_time]))[target_time]
+
+async def grid_lookup(db, user, halls, target_time, optimizer):
+    """(selected, totals) of the halls whose cell for this user is in the grid, by hall"""
+    cells = await get_grid(db, target_time)
+    include, exclude = compile_plans(user.plans)
+    bucket = target_bucket(user.protein, user.carbs, user.fat, user.cals)
+
+    found = {}
+    for hall in halls:
+        cell = cells.get(cell_key(hall, optimizer, include, exclude, bucket))
+        if cell is None:
+            grid_stats.misses += 1
+        else:
+            grid_stats.hits += 1
+            found[hall] = cell
+    return found
@@ -0,0 +1,105 @@
+import asyncio
+import hashlib
+import io
+import os
+
+from PIL import Image, ImageOps
+
+# Longest side sent to the model, anything bigger only costs upload and model time
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1536))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+
+# Pixels we're willing to decode at full size. JPEGs are decoded scaled down so
+# this only bites formats that can't be, it keeps a small PNG or GIF that
+# claims huge dimensions from ballooning a worker
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", 25_000_000))
+
+# Decodes running at once, each holds up to ~20 MB of pixels while it runs
+IMAGE_DECODE_CONCURRENCY = int(os.getenv("IMAGE_DECODE_CONCURRENCY", 2))
+
+_decode_slots = asyncio.Semaphore(IMAGE_DECODE_CONCURRENCY)
+
+# Uploads up to this size that are already small and upright are sent as they are
+IMAGE_PASSTHROUGH_BYTES = int(os.getenv("IMAGE_PASSTHROUGH_BYTES", 1024 * 1024))
+
+# Formats the model accepts as they are, anything else PIL can read is re-encoded
+PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# EXIF tag holding the camera's rotation, 1 means already upright
+ORIENTATION = 0x0112
+
+class ImageTooLarge(Exception):
+    pass
+
+class PreparedImage:
+    """Model-ready bytes of an upload, their mime type and a hash of the pixels they show"""
+
+    def __init__(self, data, mime_type, digest, size):
+        self.data = data
+        self.mime_type = mime_type
+        self.digest = digest
+        self.size = size
+
+    def __repr__(self):
+        return f"PreparedImage({self.mime_type}, {self.size[0]}x{self.size[1]}, {len(self.data)} bytes)"
+
+def prepare_image(source):
+    """
+    Decode an upload, rotate it upright and shrink it to IMAGE_MAX_DIMENSION.
+
+    source is the upload's bytes or a seekable file holding them. PIL reads a
+    file as it decodes, and JPEGs are decoded straight at the smallest
+    1/2, 1/4 or 1/8 scale that still covers IMAGE_MAX_DIMENSION, so a 12 MP
+    photo never exists in memory at full size.
+
+    Uploads that are already small, upright and in a format the model reads
+    are sent unchanged, everything else is re-encoded as JPEG. The digest is
+    taken over the final pixels, so the same photo re-uploaded with different
+    metadata or orientation tags still hashes the same.
+
+    Raises:
+        PIL.UnidentifiedImageError: If the bytes aren't an image PIL can read
+        ImageTooLarge: If decoding would take more than IMAGE_MAX_PIXELS pixels
+        OSError: If the image is truncated or otherwise can't be decoded
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    source.seek(0, io.SEEK_END)
+    length = source.tell()
+    source.seek(0)
+
+    try:
+        with Image.open(source) as image:
+            detected = image.format
+            upright = image.getexif().get(ORIENTATION, 1) == 1
+            small = max(image.size) <= IMAGE_MAX_DIMENSION
+
+            scale = min(1.0, IMAGE_MAX_DIMENSION / max(image.size))
+            image.draft("RGB", (int(image.size[0] * scale), int(image.size[1] * scale)))
+            if image.size[0] * image.size[1] > IMAGE_MAX_PIXELS:
+                raise ImageTooLarge(f"{image.size[0]}x{image.size[1]} is too many pixels to decode")
+
+            # Shrinking before rotating means the rotation only copies the small image
+            image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.Resampling.LANCZOS)
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            digest = hashlib.sha256(repr((image.mode, image.size)).encode())
+            digest.update(image.tobytes())
+            digest = digest.hexdigest()
+
+            if detected in PASSTHROUGH_FORMATS and upright and small and length <= IMAGE_PASSTHROUGH_BYTES:
+                source.seek(0)
+                return PreparedImage(source.read(), PASSTHROUGH_FORMATS[detected], digest, image.size)
+
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            return PreparedImage(output.getvalue(), "image/jpeg", digest, image.size)
+    except Image.DecompressionBombError as e:
+        # Raised by Image.open itself for headers claiming far more than PIL's own limit
+        raise ImageTooLarge(str(e)) from e
+
+async def prepare_upload(source):
+    """prepare_image on a worker thread, at most IMAGE_DECODE_CONCURRENCY at a time"""
+    async with _decode_slots:
+        return await asyncio.to_thread(prepare_image, source)
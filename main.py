@@ -1,23 +1,40 @@
 from fastapi import FastAPI, HTTPException, Depends, Response, Request, Cookie, Body
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
-from typing import List, Annotated
+from typing import List, Annotated, Literal
 import schema
-from database import get_db
+from database import get_async_db, async_engine, AsyncSessionLocal
 from auth_handler import sign_jwt, decode_jwt
-from optimize import find_optimal_foods_greedy, create_food_item, find_optimal_foods_balanced
+from optimize import find_optimal_foods_greedy, find_optimal_foods_balanced
+from menu_cache import DINING_HALLS, MEAL_TIMES, meal_target_time, get_menu_snapshot, invalidate_menus
+from menu_context import get_menu_context, invalidate_contexts
+from result_cache import result_cache, result_key, invalidate_user
+from user_cache import get_profile, store_profile
+from caching import cache_stats
+from solver import shutdown_executor
+from recommend import BATCH_CONCURRENCY, BATCH_MAX_DAYS, meal_targets, prefetch_meals, solve_menu, solve_menus
+import asyncio
 import os
 from fastapi.responses import StreamingResponse
 from advisor_ai import *
-import datetime
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
+from image_prep import prepare_upload, ImageTooLarge
+from uploads import read_upload, upload_openapi
 import io
 import json
-from fastapi import UploadFile, HTTPException, File
 import pytz
+from contextlib import asynccontextmanager
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_genai_client()
+    yield
+    stop_genai_client()
+    shutdown_executor()
+    await async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,33 +45,60 @@ app.add_middleware(
 )
 
 @app.post("/generate-meal-plan-stream")
-async def generate_meal_plan_stream(request: MealPlanRequest = Body(...)):
+async def generate_meal_plan_stream(request: Request, plan_request: MealPlanRequest = Body(...),
+                                    stream_format: Literal["text", "ndjson", "sse"] = "text"):
     if not os.getenv("GOOGLE_API_KEY"):
         raise HTTPException(
             status_code=500, detail="GOOGLE_API_KEY environment variable not set."
         )
+
+    food_info = plan_request.food_info
+    if food_info is None:
+        if plan_request.meal_type is not None and plan_request.meal_type not in MEAL_TIMES:
+            raise HTTPException(status_code=400, detail="Invalid meal type")
+        # Its own session rather than Depends, which would hold a connection until the stream ends
+        async with AsyncSessionLocal() as db:
+            plans = None
+            decoded = decode_jwt(request.cookies.get('token'), os.environ["JWT_SECRET"])
+            if decoded:
+                user = await get_profile(db, decoded['user_id'])
+                plans = user.plans if user else None
+            food_info = await get_menu_context(db, plan_request.day, plan_request.meal_type, plans)
     
     return StreamingResponse(
-        stream_generator(request.user_goal, request.food_info, request.chat_history),
-        media_type="text/plain",
+        event_stream(stream_generator(plan_request.user_goal, food_info, plan_request.chat_history,
+                                      plan_request.conversation_id), stream_format),
+        media_type=STREAM_MEDIA_TYPES[stream_format],
     )
 
-@app.post("/estimate-nutrition")
-async def estimate_nutrition(file: UploadFile = File(...)):
+@app.post("/estimate-nutrition", openapi_extra=upload_openapi("file"))
+async def estimate_nutrition(request: Request, stream_format: Literal["text", "ndjson", "sse"] = "text"):
     if not os.getenv("GOOGLE_API_KEY"):
         raise HTTPException(
             status_code=500, detail="GOOGLE_API_KEY environment variable not set."
         )
     
-    image_bytes = await file.read()
+    upload = await read_upload(request, "file")
+
+    try:
+        image = await prepare_upload(upload.file)
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Upload is not a supported image")
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except OSError:
+        # Truncated or corrupt, e.g. an upload cut short by a flaky connection
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Upload is truncated or corrupt")
+    finally:
+        await upload.close()
     
     return StreamingResponse(
-        image_stream_generator(image_bytes),
-        media_type="text/plain",
+        event_stream(image_stream_generator(image), stream_format),
+        media_type=STREAM_MEDIA_TYPES[stream_format],
     )
     
 @app.get("/register")
-async def new_user(request: Request, response: Response, db: Session = Depends(get_db)):
+async def new_user(request: Request, response: Response, db: AsyncSession = Depends(get_async_db)):
     if request.cookies.get("token") is not None:
         return {"cookie set":"please hold"}
     try:
@@ -62,8 +106,8 @@ async def new_user(request: Request, response: Response, db: Session = Depends(g
         # Create new user
         db_user = schema.User(**{})
         db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
 
         token = sign_jwt(db_user.id, os.environ["JWT_SECRET"])
 
@@ -71,18 +115,18 @@ async def new_user(request: Request, response: Response, db: Session = Depends(g
         
         return {"success": "YAYYYYY"}
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error creating user: {str(e)}"
         )
 
 @app.post("/update_user_macs", response_model=schema.RequestResponse)
-async def update_user(response: Response, request: Request, update: schema.UserValuesUpdate, db: Session = Depends(get_db)):
+async def update_user(response: Response, request: Request, update: schema.UserValuesUpdate, db: AsyncSession = Depends(get_async_db)):
     decoded = decode_jwt(request.cookies.get('token'), os.environ["JWT_SECRET"])
     try:
         # Use the actual User model, not schema
-        user = db.query(schema.User).filter(schema.User.id == decoded['user_id']).first()
+        user = await db.get(schema.User, decoded['user_id'])
         if not user:
             return schema.RequestResponse(success=False, message="User does not exist")
             
@@ -94,7 +138,9 @@ async def update_user(response: Response, request: Request, update: schema.UserV
             user.carbs = update.carbs
         if update.fat is not None:
             user.fat = update.fat
-        db.commit()
+        await db.commit()
+        store_profile(user)
+        invalidate_user(user.id)
         return schema.RequestResponse(success=True, message="Ok")
         
     except Exception as e:
@@ -104,15 +150,17 @@ async def update_user(response: Response, request: Request, update: schema.UserV
         )
 
 @app.post("/update_user_prefs", response_model=schema.RequestResponse)
-async def update_user_prefs(response:Response, request:Request, update: schema.UserPrefsUpdate, db: Session = Depends(get_db)):
+async def update_user_prefs(response:Response, request:Request, update: schema.UserPrefsUpdate, db: AsyncSession = Depends(get_async_db)):
     decoded = decode_jwt(request.cookies.get('token'), os.environ["JWT_SECRET"])
     try:
-        user = db.query(schema.User).filter(schema.User.id == decoded['user_id']).first()
+        user = await db.get(schema.User, decoded['user_id'])
 
         user.plans = update.prefs
 
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
+        store_profile(user)
+        invalidate_user(user.id)
         return schema.RequestResponse(success=True, message="Ok")
     except Exception as e:
         raise HTTPException(
@@ -121,215 +169,133 @@ async def update_user_prefs(response:Response, request:Request, update: schema.U
         )
         
 
+async def mean_recommendation(user, target_time, optimizer):
+    """/recommend_mean's response: the foods of the hall that gets closest to the user's targets"""
+    key = result_key(user, "recommend_mean", None, target_time, optimizer)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    targets = meal_targets(user)
+    results, timings = await solve_menus(user, DINING_HALLS, target_time, optimizer)
+
+    name = find_best_hall(*targets, {hall: totals for hall, (_, totals) in results.items()})
+    sol = results[name][0] if name is not None else []
+
+    foods_json = []
+    for food in sol:
+        foods_json.append({
+            "name": food.name,
+            "protein": food.protein,
+            "carbs": food.carbs,
+            "fat": food.fat,
+            "calories": food.cals
+        })
+
+    result = {"foods": foods_json, "name": name, "solve_ms": timings}
+    # A hall that ran out of time (queued behind a burst, say) could have been the best one, so
+    # a partial answer isn't kept for the next request
+    if name is not None and None not in timings.values():
+        result_cache.set(key, result)
+    return result
+
 @app.post("/recommend_mean")
-async def get_mean(response: Response, data: schema.RecommendRequest, request: Request, db: Session = Depends(get_db)):
+async def get_mean(response: Response, data: schema.RecommendRequest, request: Request, db: AsyncSession = Depends(get_async_db)):
     decoded = decode_jwt(request.cookies.get('token'), os.environ["JWT_SECRET"])
     try:
-        user = db.query(schema.User).filter(schema.User.id == decoded['user_id']).first()
+        user = await get_profile(db, decoded['user_id'])
         
-        meal_times = {
-            "breakfast": 8.5,
-            "lunch": 12.0,
-            "dinner": 18.0
-        }
-        
-        if data.meal_type not in meal_times:
+        if data.meal_type not in MEAL_TIMES:
             raise HTTPException(status_code=400, detail="Invalid meal type")
         
-        target_date = datetime.datetime.now().date() + datetime.timedelta(days=data.day)
-        meal_hour = meal_times[data.meal_type]
-        target_time = datetime.datetime.combine(
-            target_date,
-            datetime.time(hour=int(meal_hour), minute=int((meal_hour % 1) * 60))
-        )
-        
-        base = db.query(schema.Food).join(
-            schema.Menu,
-            schema.Food.id == schema.Menu.item_id
-        ).filter(
-            schema.Food.nutrition != "{}",
-            schema.Menu.start_time <= target_time,
-            schema.Menu.end_time >= target_time
+        return await mean_recommendation(user, meal_target_time(data.day, data.meal_type), data.optimizer)
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error: {str(e)}"
         )
-        
-        items = base
 
-        if user.plans is None:
-            user.plans = []
-            db.commit()
+async def week_cells(user, meals, optimizer):
+    """Yield a /recommend_mean result or error for each (day, meal_type, target_time) as soon as it's solved"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
 
-        if "Vegan" in user.plans:
-            items = items.filter(schema.Food.traits.any("Vegan"))
-        if "Vegetarian" in user.plans:
-            items = items.filter(schema.Food.traits.any("Vegetarian"))
-        
+    async def run(day, meal_type, target_time):
+        async with semaphore:
+            try:
+                result = await mean_recommendation(user, target_time, optimizer)
+                return {"type": "cell", "day": day, "meal_type": meal_type, **result}
+            except Exception as e:
+                return {"type": "cell_error", "day": day, "meal_type": meal_type, "detail": f"Error: {str(e)}"}
 
-        if "Peanuts" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Peanuts"))
-        if "Dairy" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Milk"))
-        if "Eggs" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Eggs"))
-        if "Fish" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Fish"))
-        if "Shellfish" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Shellfish"))
-        if "Soy" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Soy"))
-        if "Gluten" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Gluten"))
-
-        earhart = items.filter(schema.Menu.location == "Earhart").all()
-        ford = items.filter(schema.Menu.location == "Ford").all()
-        hilly = items.filter(schema.Menu.location == "Hillenbrand").all()
-        wiley = items.filter(schema.Menu.location == "Wiley").all()
-        windsor = items.filter(schema.Menu.location == "Windsor").all()
-
-        e_list = []
-        for entry in earhart:
-            if "Sauce" in entry.name:
-                continue
-            e_list.append(create_food_item(entry.name, entry.nutrition))
-
-        f_list = []
-        for entry in ford:
-            if "Sauce" in entry.name:
-                continue
-            f_list.append(create_food_item(entry.name, entry.nutrition))
-
-        h_list = []
-        for entry in hilly:
-            if "Sauce" in entry.name:
-                continue
-            h_list.append(create_food_item(entry.name, entry.nutrition))
-        
-        w_list = []
-        for entry in wiley:
-            if "Sauce" in entry.name:
-                continue
-            w_list.append(create_food_item(entry.name, entry.nutrition))
-        
-        wi_list = []
-        for entry in windsor:
-            if "Sauce" in entry.name:
-                continue
-            wi_list.append(create_food_item(entry.name, entry.nutrition))
-        
-        e_result, e_tot = find_optimal_foods_balanced(user.protein / 3, user.carbs / 3, user.fat / 3, user.cals / 3, e_list)
-        f_result, f_tot = find_optimal_foods_balanced(user.protein / 3, user.carbs / 3, user.fat / 3, user.cals / 3, f_list)
-        h_result, h_tot = find_optimal_foods_balanced(user.protein / 3, user.carbs / 3, user.fat / 3, user.cals / 3, h_list)
-        w_result, w_tot = find_optimal_foods_balanced(user.protein / 3, user.carbs / 3, user.fat / 3, user.cals / 3, w_list)
-        wi_result, wi_tot = find_optimal_foods_balanced(user.protein / 3, user.carbs / 3, user.fat / 3, user.cals / 3, wi_list)
-        
-        r = find_best_hall(user.protein / 3, user.carbs / 3, user.fat / 3, user.cals / 3, e_tot, f_tot, h_tot, w_tot, wi_tot)
-
-        sol = None
-        name = None
-        if r == "e":
-            sol = e_result
-            name = "Earhart"
-        if r == "f":
-            sol = f_result
-            name = "Ford"
-        if r == "h":
-            sol = h_result
-            name = "Hillenbrand"
-        if r == "w":
-            sol = w_result
-            name = "Wiley"
-        if r == "wi":
-            sol = wi_result
-            name = "Windsor"
+    for cell in asyncio.as_completed([run(*meal) for meal in meals]):
+        yield await cell
 
-        foods_json = []
-        for food in sol:
-            foods_json.append({
-                "name": food.name,
-                "protein": food.protein,
-                "carbs": food.carbs,
-                "fat": food.fat,
-                "calories": food.cals
-            })
-        
-        return {"foods": foods_json, "name": name}
+async def week_lines(user, meals, optimizer):
+    async for cell in week_cells(user, meals, optimizer):
+        yield json.dumps(cell) + "\n"
+    yield json.dumps({"type": "done"}) + "\n"
+
+@app.post("/recommend_week")
+async def get_week(data: schema.WeekPlanRequest, request: Request, stream_format: Literal["json", "ndjson"] = "json"):
+    """
+    /recommend_mean for every meal of data.days days from data.start_day in one request.
+
+    Menus and grid cells for all of them are loaded with one query each. With
+    stream_format=ndjson every meal is sent as soon as it's solved, followed
+    by a done line, otherwise they all come back together in day and meal order.
+    """
+    decoded = decode_jwt(request.cookies.get('token'), os.environ["JWT_SECRET"])
+    meal_types = data.meal_types or list(MEAL_TIMES)
+    if any(meal_type not in MEAL_TIMES for meal_type in meal_types):
+        raise HTTPException(status_code=400, detail="Invalid meal type")
+    if not 1 <= data.days <= BATCH_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"days must be between 1 and {BATCH_MAX_DAYS}")
 
+    meals = [
+        (day, meal_type, meal_target_time(day, meal_type))
+        for day in range(data.start_day, data.start_day + data.days)
+        for meal_type in meal_types
+    ]
+    try:
+        # Its own session rather than Depends, which would hold a connection until the stream ends
+        async with AsyncSessionLocal() as db:
+            user = await get_profile(db, decoded['user_id'])
+            uncached = [
+                target_time for _, _, target_time in meals
+                if result_key(user, "recommend_mean", None, target_time, data.optimizer) not in result_cache
+            ]
+            if uncached:
+                await prefetch_meals(db, DINING_HALLS, uncached)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error: {str(e)}"
         )
 
+    if stream_format == "ndjson":
+        return StreamingResponse(week_lines(user, meals, data.optimizer), media_type="application/x-ndjson")
+
+    cells = {(cell["day"], cell["meal_type"]): cell async for cell in week_cells(user, meals, data.optimizer)}
+    return {"cells": [cells[day, meal_type] for day, meal_type, _ in meals]}
+
 @app.post("/recommend")
-async def get_recs_hilly(response: Response, data: schema.RecommendRequest, request: Request, db: Session = Depends(get_db)):
+async def get_recs_hilly(response: Response, data: schema.RecommendRequest, request: Request, db: AsyncSession = Depends(get_async_db)):
     decoded = decode_jwt(request.cookies.get('token'), os.environ["JWT_SECRET"])
     try:
-        user = db.query(schema.User).filter(schema.User.id == decoded['user_id']).first()
-        
-        meal_times = {
-            "breakfast": 8.5,
-            "lunch": 12.0,
-            "dinner": 18.0
-        }
+        user = await get_profile(db, decoded['user_id'])
         
-        if data.meal_type not in meal_times:
+        if data.meal_type not in MEAL_TIMES:
             raise HTTPException(status_code=400, detail="Invalid meal type")
         
-        target_date = datetime.datetime.now().date() + datetime.timedelta(days=data.day)
-        meal_hour = meal_times[data.meal_type]
-        target_time = datetime.datetime.combine(
-            target_date,
-            datetime.time(hour=int(meal_hour), minute=int((meal_hour % 1) * 60))
-        )
-        
-        base = db.query(schema.Food).join(
-            schema.Menu,
-            schema.Food.id == schema.Menu.item_id
-        ).filter(
-            schema.Food.nutrition != "{}",
-            schema.Menu.start_time <= target_time,
-            schema.Menu.end_time >= target_time
-        )
-        
-        items = base.filter(schema.Menu.location == data.hall)
-
-        if user.plans is None:
-            user.plans = []
-            db.commit()
-            db.refresh(user)
-
-        if "Vegan" in user.plans:
-            items = items.filter(schema.Food.traits.any("Vegan"))
-        if "Vegetarian" in user.plans:
-            items = items.filter(schema.Food.traits.any("Vegetarian"))
-        
-
-        if "Peanuts" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Peanuts"))
-        if "Dairy" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Milk"))
-        if "Eggs" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Eggs"))
-        if "Fish" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Fish"))
-        if "Shellfish" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Shellfish"))
-        if "Soy" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Soy"))
-        if "Gluten" in user.plans:
-            items = items.filter(~schema.Food.traits.any("Gluten"))
-        
-        items = items.all()
+        target_time = meal_target_time(data.day, data.meal_type)
 
-        if items is None:
-            items = []
+        key = result_key(user, "recommend", data.hall, target_time, data.optimizer)
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached
 
-        items_list = []
-        for entry in items:
-            if "Sauce" in entry.name:
-                continue
-            items_list.append(create_food_item(entry.name, entry.nutrition))
-        
-        result_list, totals = find_optimal_foods_balanced(user.protein / 3, user.carbs / 3, user.fat / 3, user.cals / 3, items_list)
+        result_list, totals, solve_ms = await solve_menu(user, data.hall, target_time, data.optimizer)
         
         foods_json = []
         for food in result_list:
@@ -341,7 +307,9 @@ async def get_recs_hilly(response: Response, data: schema.RecommendRequest, requ
                 "calories": food.cals
             })
         
-        return {"foods": foods_json}
+        result = {"foods": foods_json}
+        result_cache.set(key, result)
+        return result
         
     except Exception as e:
         raise HTTPException(
@@ -349,67 +317,45 @@ async def get_recs_hilly(response: Response, data: schema.RecommendRequest, requ
             detail=f"Error: {str(e)}"
         )
 
+@app.get("/cache_stats")
+async def get_cache_stats():
+    return cache_stats()
+
+@app.post("/menus/invalidate", response_model=schema.RequestResponse)
+async def invalidate_menu_cache(request: Request, location: str = None):
+    # Called by the menu ingestion job once it has written new menus
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or request.headers.get("x-admin-token") != admin_token:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    dropped = invalidate_menus(location)
+    invalidate_contexts()
+    return schema.RequestResponse(success=True, message=f"Dropped {dropped} menu snapshots")
+
 @app.post("/rectest")
-async def test(day: int, hall: str, meal_type: str, data: schema.GetMealRequest, db: Session = Depends(get_db)):
-    # Define meal times
-    meal_times = {
-        "breakfast": 8.5,  # 8:30 AM
-        "lunch": 12.0,     # 12:00 PM  
-        "dinner": 18.0     # 6:00 PM
-    }
-    
-    if meal_type not in meal_times:
+async def test(day: int, hall: str, meal_type: str, data: schema.GetMealRequest, db: AsyncSession = Depends(get_async_db)):
+    if meal_type not in MEAL_TIMES:
         raise HTTPException(status_code=400, detail="Invalid meal type. Use: breakfast, lunch, dinner")
     
-    # Get the target date and set specific meal time
-    target_date = datetime.datetime.now().date() + datetime.timedelta(days=day)
-    meal_hour = meal_times[meal_type]
+    snapshot = await get_menu_snapshot(db, hall, meal_target_time(day, meal_type))
     
-    # Create datetime for the specific meal time
-    target_time = datetime.datetime.combine(
-        target_date, 
-        datetime.time(hour=int(meal_hour), minute=int((meal_hour % 1) * 60))
-    )
-    
-    base = db.query(schema.Food).join(
-        schema.Menu,
-        schema.Food.id == schema.Menu.item_id
-    ).filter(
-        schema.Food.nutrition != "{}",
-        schema.Menu.start_time <= target_time,  # Menu starts before or at meal time
-        schema.Menu.end_time >= target_time     # Menu ends after or at meal time
-    )
-    
-    items = base.filter(schema.Menu.location == hall).all()
-    items_list = []
-    for entry in items:
-        if "Sauce" in entry.name:
-            continue
-        items_list.append(create_food_item(entry.name, entry.nutrition))
-    
-    result_list = find_optimal_foods_balanced(data.protein, data.carbs, data.fat, data.cals, items_list)
+    result_list = find_optimal_foods_balanced(data.protein, data.carbs, data.fat, data.cals, snapshot.matrix)
     return result_list
 
-def find_best_hall(target_protein, target_carbs, target_fat, target_cals, 
-                   e_tot, f_tot, h_tot, w_tot, wi_tot):
+def find_best_hall(target_protein, target_carbs, target_fat, target_cals, hall_totals):
     """
     Find which dining hall total is closest to targets
     
+    Args:
+        hall_totals: Dict of hall name to (protein, carbs, fat, cals) totals
+    
     Returns:
-        String name of the best hall ('e', 'f', 'h', 'w', or 'wi')
+        Name of the best hall, or None if no hall has totals
     """
-    halls = {
-        'e': e_tot,
-        'f': f_tot, 
-        'h': h_tot,
-        'w': w_tot,
-        'wi': wi_tot
-    }
-    
     best_hall = None
     best_score = float('inf')
     
-    for hall_name, totals in halls.items():
+    for hall_name, totals in hall_totals.items():
         if totals is None:
             continue
             
@@ -0,0 +1,247 @@
+import bisect
+import datetime
+import os
+
+import numpy as np
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.orm import load_only
+
+import schema
+from caching import TTLCache, register
+from optimize import MacroMatrix, food_item_from_row, prune_duplicates
+from traits import encode_traits, compile_plans, matching
+
+# Halls compared by /recommend_mean, adding a dining court here is all it takes
+DINING_HALLS = ("Earhart", "Ford", "Hillenbrand", "Wiley", "Windsor")
+
+MEAL_TIMES = {
+    "breakfast": 8.5,  # 8:30 AM
+    "lunch": 12.0,     # 12:00 PM
+    "dinner": 18.0     # 6:00 PM
+}
+
+snapshot_cache = TTLCache(
+    "menu_snapshots",
+    maxsize=int(os.getenv("MENU_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("MENU_CACHE_TTL", 3600)),
+)
+
+# Largest basket any optimizer builds, copies of a food beyond this are pruned
+MAX_MEAL_ITEMS = 5
+
+class PruneStats:
+    """How much prune_duplicates shrinks snapshots before they reach an optimizer"""
+
+    def __init__(self):
+        self.snapshots = 0
+        self.foods_before = 0
+        self.foods_after = 0
+
+    def record(self, before, after):
+        self.snapshots += 1
+        self.foods_before += before
+        self.foods_after += after
+
+    def stats(self):
+        return {
+            "snapshots": self.snapshots,
+            "foods_before": self.foods_before,
+            "foods_after": self.foods_after,
+            "pruned_ratio": 1 - self.foods_after / self.foods_before if self.foods_before else 0.0,
+        }
+
+prune_stats = register("menu_pruning", PruneStats())
+
+class MenuSnapshot:
+    """
+    Decoded foods served at one hall for one meal, with the traits of each as a set and a bitmask.
+
+    foods, traits and food_masks list everything served. matrix and
+    trait_masks, what the optimizers pick from, leave out copies past
+    MAX_MEAL_ITEMS of the same macros and traits.
+    """
+
+    def __init__(self, location, target_time, foods, traits):
+        masks = [encode_traits(food_traits) for food_traits in traits]
+        kept = prune_duplicates(foods, masks, keep=MAX_MEAL_ITEMS)
+        prune_stats.record(len(foods), len(kept))
+
+        self.location = location
+        self.target_time = target_time
+        self.foods = foods
+        self.traits = traits
+        self.food_masks = np.array(masks, dtype=np.int64)
+        self.trait_masks = self.food_masks[kept]
+        self.pruned = len(foods) - len(kept)
+        self.matrix = MacroMatrix([foods[i] for i in kept])
+
+    def __repr__(self):
+        return f"MenuSnapshot('{self.location}', {self.target_time}, {len(self.foods)} foods, {self.pruned} pruned)"
+
+def meal_target_time(day, meal_type):
+    """Datetime of the given meal, `day` days from today. Raises KeyError for unknown meals"""
+    target_date = datetime.datetime.now().date() + datetime.timedelta(days=day)
+    meal_hour = MEAL_TIMES[meal_type]
+    return datetime.datetime.combine(
+        target_date,
+        datetime.time(hour=int(meal_hour), minute=int((meal_hour % 1) * 60))
+    )
+
+def seconds_until_next_menu_day():
+    """Seconds until midnight, when day=0 starts meaning tomorrow's menus"""
+    now = datetime.datetime.now()
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    return (midnight - now).total_seconds()
+
+# Snapshots only read the macro columns, the label text stays in the database
+SNAPSHOT_FOOD = load_only(schema.Food.id, schema.Food.name, schema.Food.traits, schema.Food.calories,
+                          schema.Food.protein, schema.Food.carbs, schema.Food.fat)
+
+# The label text, but only for rows whose macro columns are missing or no longer match it
+STALE_NUTRITION = case(
+    (and_(schema.Food.calories.is_not(None), schema.Food.nutrition_hash == func.md5(schema.Food.nutrition)), None),
+    else_=schema.Food.nutrition,
+).label("stale_nutrition")
+
+def menu_statement(locations, target_time):
+    """(Food, stale nutrition, Menu.location) rows served at any of the locations at target_time"""
+    return select(schema.Food, STALE_NUTRITION, schema.Menu.location).options(SNAPSHOT_FOOD).join(
+        schema.Menu,
+        schema.Food.id == schema.Menu.item_id
+    ).where(
+        schema.Food.nutrition != "{}",
+        schema.Menu.start_time <= target_time,
+        schema.Menu.end_time >= target_time,
+        schema.Menu.location.in_(locations)
+    )
+
+async def load_snapshots(db, locations, target_time):
+    """Build snapshots for several halls from a single menu query"""
+    rows = (await db.execute(menu_statement(locations, target_time))).all()
+
+    foods = {location: [] for location in locations}
+    traits = {location: [] for location in locations}
+    for entry, stale_nutrition, location in rows:
+        if "Sauce" in entry.name:
+            continue
+        foods[location].append(food_item_from_row(entry, stale_nutrition))
+        traits[location].append(frozenset(entry.traits) if entry.traits is not None else None)
+
+    return {
+        location: MenuSnapshot(location, target_time, foods[location], traits[location])
+        for location in locations
+    }
+
+async def get_menu_snapshots(db, locations, target_time):
+    """Snapshots for every location, querying only the ones not already cached"""
+    snapshots = {}
+    missing = []
+    for location in locations:
+        snapshot = snapshot_cache.get((location, target_time))
+        if snapshot is None:
+            missing.append(location)
+        else:
+            snapshots[location] = snapshot
+
+    if missing:
+        version = menu_version()
+        for location, snapshot in (await load_snapshots(db, missing, target_time)).items():
+            # Menus invalidated while we queried may be what we just read, serve them once but don't keep them
+            if menu_version() == version:
+                snapshot_cache.set((location, target_time), snapshot)
+            snapshots[location] = snapshot
+
+    return {location: snapshots[location] for location in locations}
+
+def menu_range_statement(locations, start, end):
+    """(Food, stale nutrition, Menu.location, Menu.start_time, Menu.end_time) rows served at any of the locations between start and end"""
+    return select(
+        schema.Food, STALE_NUTRITION, schema.Menu.location, schema.Menu.start_time, schema.Menu.end_time
+    ).options(SNAPSHOT_FOOD).join(
+        schema.Menu,
+        schema.Food.id == schema.Menu.item_id
+    ).where(
+        schema.Food.nutrition != "{}",
+        schema.Menu.start_time <= end,
+        schema.Menu.end_time >= start,
+        schema.Menu.location.in_(locations)
+    )
+
+async def load_snapshot_range(db, locations, target_times):
+    """
+    Build snapshots for every (location, target_time) pair from a single menu query.
+
+    Each food is decoded once, however many meals serve it.
+    """
+    target_times = sorted(set(target_times))
+    rows = (await db.execute(menu_range_statement(locations, target_times[0], target_times[-1]))).all()
+
+    decoded = {}
+    foods = {(location, target_time): [] for location in locations for target_time in target_times}
+    traits = {key: [] for key in foods}
+    for entry, stale_nutrition, location, start_time, end_time in rows:
+        if "Sauce" in entry.name:
+            continue
+        if entry.id not in decoded:
+            decoded[entry.id] = (food_item_from_row(entry, stale_nutrition),
+                                 frozenset(entry.traits) if entry.traits is not None else None)
+        food, food_traits = decoded[entry.id]
+        # The target times whose meal this menu entry is served at
+        for target_time in target_times[bisect.bisect_left(target_times, start_time):
+                                        bisect.bisect_right(target_times, end_time)]:
+            foods[location, target_time].append(food)
+            traits[location, target_time].append(food_traits)
+
+    return {
+        (location, target_time): MenuSnapshot(location, target_time, foods[location, target_time],
+                                              traits[location, target_time])
+        for location, target_time in foods
+    }
+
+async def get_menu_snapshot_range(db, locations, target_times):
+    """Snapshots by (location, target_time) for every pair, querying only the ones not already cached"""
+    snapshots = {}
+    missing = set()
+    for location in locations:
+        for target_time in target_times:
+            snapshot = snapshot_cache.get((location, target_time))
+            if snapshot is None:
+                missing.add((location, target_time))
+            else:
+                snapshots[location, target_time] = snapshot
+
+    if missing:
+        version = menu_version()
+        loaded = await load_snapshot_range(
+            db, sorted({location for location, _ in missing}), [target_time for _, target_time in missing]
+        )
+        for key in missing:
+            if menu_version() == version:
+                snapshot_cache.set(key, loaded[key])
+            snapshots[key] = loaded[key]
+
+    return snapshots
+
+async def get_menu_snapshot(db, location, target_time):
+    return (await get_menu_snapshots(db, [location], target_time))[location]
+
+# Bumped by every invalidation, so results derived from snapshots can tell they're stale
+_menu_version = 0
+
+def menu_version():
+    return _menu_version
+
+def invalidate_menus(location=None):
+    """Forget cached snapshots, e.g. after menus are re-ingested"""
+    global _menu_version
+    _menu_version += 1
+    if location is None:
+        return snapshot_cache.invalidate()
+    return snapshot_cache.invalidate(lambda key: key[0] == location)
+
+def filter_foods(snapshot, plans):
+    """MacroMatrix of the snapshot's foods that satisfy every diet and allergen entry in plans"""
+    include, exclude = compile_plans(plans)
+    if not include and not exclude:
+        return snapshot.matrix.subset(slice(None))
+    return snapshot.matrix.subset(matching(snapshot.trait_masks, include, exclude))
@@ -0,0 +1,105 @@
+import os
+
+from caching import TTLCache
+from menu_cache import DINING_HALLS, MEAL_TIMES, get_menu_snapshots, meal_target_time, menu_version, seconds_until_next_menu_day
+from traits import compile_plans, matching
+
+# Rough size of the food section handed to the advisor, rows past it are left out evenly across halls
+MENU_CONTEXT_TOKENS = int(os.getenv("MENU_CONTEXT_TOKENS", 8000))
+
+# Close enough for English and numbers, we only need the budget roughly right
+CHARS_PER_TOKEN = 4
+
+CONTEXT_HEADER = "One row per item: name|kcal|protein g|carbs g|fat g|traits (allergens and diets)"
+
+context_cache = TTLCache(
+    "menu_contexts",
+    maxsize=int(os.getenv("MENU_CONTEXT_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("MENU_CACHE_TTL", 3600)),
+)
+
+def food_row(food, traits):
+    return f"{food.name}|{food.cals:.0f}|{food.protein:.0f}|{food.carbs:.0f}|{food.fat:.0f}|{','.join(sorted(traits or ()))}"
+
+def snapshot_rows(snapshot, include, exclude):
+    """Rows for the snapshot's foods that pass the plans, one per name, sorted so renders are stable"""
+    if include or exclude:
+        keep = matching(snapshot.food_masks, include, exclude)
+    else:
+        keep = [True] * len(snapshot.foods)
+
+    rows = {}
+    for food, traits, kept in zip(snapshot.foods, snapshot.traits, keep):
+        if kept and food.name not in rows:
+            rows[food.name] = food_row(food, traits)
+    return [rows[name] for name in sorted(rows)]
+
+def fit_rows(sections, budget_chars):
+    """
+    Largest per-section row count whose rows fit in budget_chars.
+
+    Every section gets the same cap, so one big hall can't crowd out the rest.
+    """
+    def size(cap):
+        return sum(len(row) + 1 for _, rows in sections for row in rows[:cap])
+
+    low, high = 0, max((len(rows) for _, rows in sections), default=0)
+    while low < high:
+        cap = (low + high + 1) // 2
+        if size(cap) <= budget_chars:
+            low = cap
+        else:
+            high = cap - 1
+    return low
+
+def render_context(sections, max_tokens=None):
+    """Compact table of (title, rows) sections within max_tokens (default MENU_CONTEXT_TOKENS)"""
+    budget = (MENU_CONTEXT_TOKENS if max_tokens is None else max_tokens) * CHARS_PER_TOKEN
+    overhead = len(CONTEXT_HEADER) + sum(len(title) + 24 for title, _ in sections)
+    cap = fit_rows(sections, budget - overhead)
+
+    lines = [CONTEXT_HEADER]
+    for title, rows in sections:
+        lines.append(f"[{title}]")
+        if not rows:
+            lines.append("(nothing that fits their plans)")
+            continue
+        lines.extend(rows[:cap])
+        if len(rows) > cap:
+            lines.append(f"(+{len(rows) - cap} more not shown)")
+    return "\n".join(lines)
+
+async def get_menu_context(db, day, meal_type=None, plans=None):
+    """
+    The advisor's food section for one day, or one meal of it, filtered by plans.
+
+    Renders are cached per (date, meals, plan masks) until the menu day ends,
+    so everyone with the same plans asking about the same meals shares one.
+
+    Raises:
+        KeyError: If meal_type isn't one of MEAL_TIMES
+    """
+    meals = [meal_type] if meal_type is not None else list(MEAL_TIMES)
+    targets = [meal_target_time(day, meal) for meal in meals]
+    include, exclude = compile_plans(plans)
+
+    key = (targets[0].date(), tuple(meals), include, exclude)
+    context = context_cache.get(key)
+    if context is not None:
+        return context
+
+    version = menu_version()
+    sections = []
+    for meal, target_time in zip(meals, targets):
+        snapshots = await get_menu_snapshots(db, DINING_HALLS, target_time)
+        for hall, snapshot in snapshots.items():
+            sections.append((f"{hall} {meal}", snapshot_rows(snapshot, include, exclude)))
+
+    context = render_context(sections)
+    # Built from menus that were invalidated meanwhile, good for this request only
+    if menu_version() == version:
+        context_cache.set(key, context, ttl=min(context_cache.ttl, seconds_until_next_menu_day()))
+    return context
+
+def invalidate_contexts():
+    return context_cache.invalidate()
@@ -0,0 +1,58 @@
+"""
+Schema migrations and data backfills for tables we don't create through the ORM.
+
+Run with `python migrate.py`. Every step is idempotent so it is safe to re-run
+after each menu ingestion.
+"""
+from sqlalchemy import func, or_, text
+from database import engine, SessionLocal
+from optimize import NUTRITION_COLUMNS, nutrition_columns
+import schema
+
+def add_nutrition_columns():
+    """Add the materialized nutrition columns to foods if they are missing"""
+    with engine.begin() as conn:
+        for column in NUTRITION_COLUMNS:
+            conn.execute(text(f"ALTER TABLE foods ADD COLUMN IF NOT EXISTS {column} DOUBLE PRECISION"))
+        conn.execute(text("ALTER TABLE foods ADD COLUMN IF NOT EXISTS nutrition_hash VARCHAR"))
+
+def backfill_nutrition(batch_size=500):
+    """
+    Decode Food.nutrition for every row that hasn't been materialized yet, or
+    whose label changed since it was, e.g. by a writer that skips the ORM listeners
+    """
+    db = SessionLocal()
+    updated = 0
+    try:
+        while True:
+            rows = db.query(schema.Food).filter(or_(
+                schema.Food.calories.is_(None),
+                schema.Food.nutrition_hash.is_distinct_from(func.md5(schema.Food.nutrition)),
+            )).limit(batch_size).all()
+            if not rows:
+                break
+
+            for food in rows:
+                for column, value in nutrition_columns(food.nutrition).items():
+                    setattr(food, column, value)
+            db.commit()
+            updated += len(rows)
+    finally:
+        db.close()
+    return updated
+
+def create_tables():
+    """Create tables added since the database was first set up"""
+    schema.GridCell.__table__.create(bind=engine, checkfirst=True)
+
+def create_indexes():
+    """Create the indexes declared on the models that the database doesn't have yet"""
+    for table in (schema.Menu.__table__, schema.Food.__table__):
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+if __name__ == "__main__":
+    add_nutrition_columns()
+    create_tables()
+    create_indexes()
+    print(f"Backfilled nutrition for {backfill_nutrition()} foods")
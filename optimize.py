@@ -1,5 +1,11 @@
+import hashlib
 import re
+import os
 import json
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 
 class FoodItem:
     def __init__(self, name, protein, carbs, fat, calories):
@@ -22,16 +28,110 @@ def calculate_distance(target_protein, target_carbs, target_fat, target_cals,
     
     return protein_diff + carbs_diff + fat_diff + cals_diff
 
-def find_optimal_foods_greedy(target_protein, target_carbs, target_fat, target_cals, food_items, max_items=10):
+def is_vegetable(food):
+    return food.cals <= 50 and food.fat <= 2 and food.carbs <= 15
+
+class MacroMatrix:
+    """
+    Candidate foods as an N x 4 (protein, carbs, fat, cals) matrix with a selection mask.
+
+    best() scores every remaining candidate in one vectorized step and picks the
+    same food the per-item loops would, including their first-wins tie breaking.
+    Build one per menu and hand each request a subset() so the rows aren't
+    rebuilt from FoodItems every time.
+    """
+
+    def __init__(self, food_items=()):
+        foods = list(food_items)
+        self.foods = np.empty(len(foods), dtype=object)
+        self.foods[:] = foods
+        self.macros = np.array(
+            [(food.protein, food.carbs, food.fat, food.cals) for food in foods], dtype=np.float64
+        ).reshape(-1, 4)
+        self.sauce = np.array(["Sauce" in food.name for food in foods], dtype=bool)
+        self.vegetable = (
+            (self.macros[:, 3] <= 50) & (self.macros[:, 2] <= 2) & (self.macros[:, 1] <= 15)
+        )
+        self.available = np.ones(len(foods), dtype=bool)
+
+    def subset(self, selector):
+        """New matrix over the rows picked by an index array, boolean mask or slice"""
+        sub = MacroMatrix.__new__(MacroMatrix)
+        sub.foods = self.foods[selector]
+        sub.macros = self.macros[selector]
+        sub.sauce = self.sauce[selector]
+        sub.vegetable = self.vegetable[selector]
+        sub.available = np.ones(len(sub.foods), dtype=bool)
+        return sub
+
+    def __len__(self):
+        return int(self.available.sum())
+
+    def best(self, targets, current, vegetable_bonus=0):
+        """Index of the available food whose addition lands closest to targets, or None"""
+        if not len(self.foods):
+            return None
+        diff = np.abs(np.asarray(targets, dtype=np.float64) - (np.asarray(current, dtype=np.float64) + self.macros))
+        # Same summation order as calculate_distance so ties resolve identically
+        distance = diff[:, 0] + diff[:, 1] + diff[:, 2] + diff[:, 3]
+        if vegetable_bonus:
+            distance = distance + np.where(self.vegetable, vegetable_bonus, 0)
+        distance[~self.available | np.isnan(distance)] = np.inf
+
+        index = int(np.argmin(distance))
+        if distance[index] == np.inf:
+            return None
+        return index
+
+    def take(self, index):
+        self.available[index] = False
+        return self.foods[index]
+
+def as_matrix(food_items):
+    """Fresh MacroMatrix for food_items with every row available, even rows an existing one had already taken"""
+    if isinstance(food_items, MacroMatrix):
+        return food_items.subset(slice(None))
+    return MacroMatrix(food_items)
+
+def as_list(food_items):
+    if isinstance(food_items, MacroMatrix):
+        return list(food_items.foods)
+    return list(food_items)
+
+def prune_duplicates(food_items, keys=None, keep=5):
+    """
+    Indices of the foods worth handing to an optimizer, in their original order.
+
+    Under the distance objective a food is only worse than another for every
+    target when their macros are identical, and no optimizer picks more than
+    `keep` foods, so copies past the first `keep` of each macro vector can never
+    be selected. keys adds anything else that must match, e.g. each food's
+    traits, so filtering afterwards can't drop the copies that were kept.
+    """
+    counts = {}
+    kept = []
+    for index, food in enumerate(as_list(food_items)):
+        key = (food.protein, food.carbs, food.fat, food.cals, keys[index] if keys is not None else None)
+        seen = counts.get(key, 0)
+        if seen < keep:
+            counts[key] = seen + 1
+            kept.append(index)
+    return kept
+
+def find_optimal_foods_greedy(target_protein, target_carbs, target_fat, target_cals, food_items, max_items=10, engine="numpy"):
     selected_foods = []
     current_protein = 0
     current_carbs = 0
     current_fat = 0
     current_cals = 0
-    available_foods = food_items.copy()
+    if engine == "numpy":
+        available_foods = as_matrix(food_items)
+    else:
+        available_foods = as_list(food_items)
+    targets = (target_protein, target_carbs, target_fat, target_cals)
     
     for _ in range(max_items):
-        if not available_foods:
+        if not len(available_foods):
             break
             
         # Check if we've reached or exceeded all targets
@@ -42,22 +142,14 @@ def find_optimal_foods_greedy(target_protein, target_carbs, target_fat, target_c
             len(selected_foods) >= 5):
             break
             
-        best_food = None
-        best_distance = float('inf')
-        
-        # Try adding each available food and see which gets us closest to target
-        for food in available_foods:
-            new_protein = current_protein + food.protein
-            new_carbs = current_carbs + food.carbs
-            new_fat = current_fat + food.fat
-            new_cals = current_cals + food.cals
-            
-            distance = calculate_distance(target_protein, target_carbs, target_fat, target_cals,
-                                        new_protein, new_carbs, new_fat, new_cals)
-            
-            if distance < best_distance:
-                best_distance = distance
-                best_food = food
+        if engine == "numpy":
+            index = available_foods.best(targets, (current_protein, current_carbs, current_fat, current_cals))
+            best_food = available_foods.take(index) if index is not None else None
+        else:
+            best_food = find_closest_food(targets, (current_protein, current_carbs, current_fat, current_cals),
+                                          available_foods)
+            if best_food:
+                available_foods.remove(best_food)
         
         if best_food:
             selected_foods.append(best_food)
@@ -65,75 +157,163 @@ def find_optimal_foods_greedy(target_protein, target_carbs, target_fat, target_c
             current_carbs += best_food.carbs
             current_fat += best_food.fat
             current_cals += best_food.cals
-            available_foods.remove(best_food)
     
     return selected_foods, (current_protein, current_carbs, current_fat, current_cals)
 
-
-def create_food_item(name, nutrition_data):
-    """Take nutrition column data and return a FoodItem object"""
+def find_closest_food(targets, current, food_items, vegetable_bonus=0):
+    """Pure Python reference for MacroMatrix.best, returns the food itself"""
+    target_protein, target_carbs, target_fat, target_cals = targets
+    current_protein, current_carbs, current_fat, current_cals = current
+    best_food = None
+    best_distance = float('inf')
     
-    # Handle PostgreSQL array format with escaped JSON
+    # Try adding each available food and see which gets us closest to target
+    for food in food_items:
+        new_protein = current_protein + food.protein
+        new_carbs = current_carbs + food.carbs
+        new_fat = current_fat + food.fat
+        new_cals = current_cals + food.cals
+        
+        distance = calculate_distance(target_protein, target_carbs, target_fat, target_cals,
+                                    new_protein, new_carbs, new_fat, new_cals)
+        if vegetable_bonus and is_vegetable(food):
+            distance += vegetable_bonus
+        
+        if distance < best_distance:
+            best_distance = distance
+            best_food = food
+    
+    return best_food
+
+
+# Columns materialized on schema.Food from the nutrition label. The first four
+# feed the optimizer; the rest are kept for the advisor and future filters.
+NUTRITION_COLUMNS = (
+    'calories', 'protein', 'carbs', 'fat',
+    'saturated_fat', 'trans_fat', 'cholesterol', 'sodium',
+    'sugar', 'added_sugar', 'fiber', 'calcium', 'iron',
+)
+
+LABEL_COLUMNS = {
+    'saturated fat': 'saturated_fat',
+    'trans fat': 'trans_fat',
+    'cholesterol': 'cholesterol',
+    'sodium': 'sodium',
+    'sugar': 'sugar',
+    'added sugar': 'added_sugar',
+    'dietary fiber': 'fiber',
+    'calcium': 'calcium',
+    'iron': 'iron',
+}
+
+def label_column(label):
+    """Map a lowercased nutrition label name to its schema.Food column, or None"""
+    if 'calories' in label and 'from fat' not in label:
+        return 'calories'
+    if 'total fat' in label:
+        return 'fat'
+    if 'total carbohydrate' in label:
+        return 'carbs'
+    if label == 'protein':
+        return 'protein'
+    return LABEL_COLUMNS.get(label)
+
+# Fallback scanner for array literals that aren't valid JSON once bracketed,
+# e.g. unquoted elements or backslash escapes JSON doesn't know
+PG_ARRAY_ELEMENT = re.compile(r'"((?:[^"\\]|\\.)*)"|([^,]+)')
+
+def split_pg_array(data_str):
+    """Split a PostgreSQL text[] literal like {"a","b"} into its element strings"""
+    inner = data_str[1:-1]
+    try:
+        # A quoted text[] body is already a valid JSON list of strings
+        parts = json.loads('[' + inner + ']')
+        if all(isinstance(part, str) for part in parts):
+            return parts
+    except json.JSONDecodeError:
+        pass
+
+    parts = []
+    for match in PG_ARRAY_ELEMENT.finditer(inner):
+        if match.group(1) is not None:
+            parts.append(match.group(1).replace('\\"', '"'))
+        elif match.group(2).strip():
+            parts.append(match.group(2).strip())
+    return parts
+
+def parse_nutrition(nutrition_data):
+    """Decode the nutrition column into a dict of {column: value} for known label facts"""
     data_str = str(nutrition_data)
     
-    # Remove outer braces and split by comma, then clean up each JSON string
     if data_str.startswith('{') and data_str.endswith('}'):
-        # Remove outer braces
-        data_str = data_str[1:-1]
-        
-        # Split by comma and parse each JSON string
-        json_parts = []
-        current_part = ""
-        in_quotes = False
-        escape_next = False
-        
-        for char in data_str:
-            if escape_next:
-                current_part += char
-                escape_next = False
-            elif char == '\\':
-                escape_next = True
-                current_part += char
-            elif char == '"' and not escape_next:
-                in_quotes = not in_quotes
-                current_part += char
-            elif char == ',' and not in_quotes:
-                if current_part.strip():
-                    # Remove surrounding quotes and unescape
-                    clean_part = current_part.strip().strip('"').replace('\\"', '"')
-                    json_parts.append(clean_part)
-                current_part = ""
-            else:
-                current_part += char
-        
-        # Don't forget the last part
-        if current_part.strip():
-            clean_part = current_part.strip().strip('"').replace('\\"', '"')
-            json_parts.append(clean_part)
+        json_parts = split_pg_array(data_str)
     else:
         json_parts = [data_str]
     
-    # Now parse each JSON string and extract nutrition values
-    calories = fat = carbs = protein = 0
+    try:
+        label_facts = json.loads('[' + ','.join(json_parts) + ']')
+    except json.JSONDecodeError:
+        # Decode fact by fact so one bad entry doesn't drop the whole label
+        label_facts = []
+        for json_str in json_parts:
+            try:
+                label_facts.append(json.loads(json_str))
+            except json.JSONDecodeError:
+                continue
     
-    for json_str in json_parts:
-        try:
-            fact = json.loads(json_str)
-            name_field = fact.get('name', '').lower()
-            value = fact.get('value')
-            
-            if value is not None:
-                if 'calories' in name_field and 'from fat' not in name_field:
-                    calories = value
-                elif 'total fat' in name_field:
-                    fat = value
-                elif 'total carbohydrate' in name_field:
-                    carbs = value
-                elif name_field == 'protein':
-                    protein = value
-        except json.JSONDecodeError:
+    facts = {}
+    for fact in label_facts:
+        if not isinstance(fact, dict):
             continue
+        value = fact.get('value')
+        if value is not None:
+            column = label_column(fact.get('name', '').lower())
+            if column is not None:
+                facts[column] = value
     
+    return facts
+
+NUTRITION_CACHE_SIZE = int(os.getenv("NUTRITION_CACHE_SIZE", 8192))
+_nutrition_cache = OrderedDict()
+_nutrition_cache_lock = threading.Lock()
+
+def cached_nutrition(food_id, nutrition_data):
+    """parse_nutrition behind a bounded LRU keyed by food id and a hash of the label text"""
+    key = (food_id, hash(nutrition_data))
+    with _nutrition_cache_lock:
+        facts = _nutrition_cache.get(key)
+        if facts is not None:
+            _nutrition_cache.move_to_end(key)
+            return facts
+
+    facts = parse_nutrition(nutrition_data)
+
+    with _nutrition_cache_lock:
+        _nutrition_cache[key] = facts
+        if len(_nutrition_cache) > NUTRITION_CACHE_SIZE:
+            _nutrition_cache.popitem(last=False)
+    return facts
+
+def nutrition_hash(nutrition_data):
+    """md5 of the label text, the same digest Postgres' md5() gives, None for a missing label"""
+    if nutrition_data is None:
+        return None
+    return hashlib.md5(nutrition_data.encode()).hexdigest()
+
+def nutrition_columns(nutrition_data):
+    """
+    Values for every NUTRITION_COLUMNS entry plus the nutrition_hash of the label they came from.
+    Missing macros default to 0 like create_food_item
+    """
+    facts = parse_nutrition(nutrition_data)
+    columns = {column: facts.get(column) for column in NUTRITION_COLUMNS}
+    for column in ('calories', 'protein', 'carbs', 'fat'):
+        if columns[column] is None:
+            columns[column] = 0
+    columns['nutrition_hash'] = nutrition_hash(nutrition_data)
+    return columns
+
+def make_food_item(name, protein, carbs, fat, calories):
     return FoodItem(
         name=name,
         protein=round(protein, 1),
@@ -142,7 +322,33 @@ def create_food_item(name, nutrition_data):
         calories=int(calories)
     )
 
-def find_optimal_foods_balanced(target_protein, target_carbs, target_fat, target_cals, food_items, max_items=5):
+def food_item_from_facts(name, facts):
+    return make_food_item(name, facts.get('protein', 0), facts.get('carbs', 0),
+                          facts.get('fat', 0), facts.get('calories', 0))
+
+def create_food_item(name, nutrition_data):
+    """Take nutrition column data and return a FoodItem object"""
+    return food_item_from_facts(name, parse_nutrition(nutrition_data))
+
+def food_item_from_row(food, stale_nutrition=None):
+    """
+    Build a FoodItem from a schema.Food row's materialized macro columns.
+
+    stale_nutrition is the row's label text when the query found those columns
+    missing or out of date (menu_cache.STALE_NUTRITION): the row predates the
+    backfill, or its label was rewritten without going through the ORM. The
+    label is decoded instead then.
+    """
+    if stale_nutrition is not None:
+        return food_item_from_facts(food.name, cached_nutrition(food.id, stale_nutrition))
+    return make_food_item(food.name, food.protein or 0, food.carbs or 0,
+                          food.fat or 0, food.calories)
+
+def find_optimal_foods_balanced(target_protein, target_carbs, target_fat, target_cals, food_items, max_items=5, engine="numpy"):
+    if engine == "numpy":
+        return find_optimal_foods_balanced_numpy(target_protein, target_carbs, target_fat, target_cals,
+                                                 as_matrix(food_items), max_items)
+    
     selected_foods = []
     current_protein = 0
     current_carbs = 0
@@ -154,7 +360,7 @@ def find_optimal_foods_balanced(target_protein, target_carbs, target_fat, target
     vegetables = []
     sides = []
     
-    for food in food_items:
+    for food in as_list(food_items):
 
         if "Sauce" in food.name:
             continue
@@ -207,30 +413,16 @@ def find_optimal_foods_balanced(target_protein, target_carbs, target_fat, target
     remaining_foods = [f for f in (sides + main_dishes + vegetables) if f not in selected_foods]
     remaining_slots = max_items - len(selected_foods)
     
+    targets = (target_protein, target_carbs, target_fat, target_cals)
+    
     for _ in range(remaining_slots):
         if not remaining_foods:
             break
         
-        best_food = None
-        best_distance = float('inf')
-        
-        for food in remaining_foods:
-            new_protein = current_protein + food.protein
-            new_carbs = current_carbs + food.carbs
-            new_fat = current_fat + food.fat
-            new_cals = current_cals + food.cals
-            
-            # Bonus for vegetables if we need more
-            vegetable_bonus = 0
-            if (food.cals <= 50 and food.fat <= 2 and food.carbs <= 15 and vegetables_added < 2):
-                vegetable_bonus = -20
-            
-            distance = calculate_distance(target_protein, target_carbs, target_fat, target_cals,
-                                        new_protein, new_carbs, new_fat, new_cals) + vegetable_bonus
-            
-            if distance < best_distance:
-                best_distance = distance
-                best_food = food
+        # Bonus for vegetables if we need more
+        vegetable_bonus = -20 if vegetables_added < 2 else 0
+        best_food = find_closest_food(targets, (current_protein, current_carbs, current_fat, current_cals),
+                                      remaining_foods, vegetable_bonus)
         
         if best_food:
             selected_foods.append(best_food)
@@ -241,7 +433,144 @@ def find_optimal_foods_balanced(target_protein, target_carbs, target_fat, target
             remaining_foods.remove(best_food)
             
             # Track vegetables
-            if (best_food.cals <= 50 and best_food.fat <= 2 and best_food.carbs <= 15):
+            if is_vegetable(best_food):
                 vegetables_added += 1
     
-    return selected_foods, (current_protein, current_carbs, current_fat, current_cals)
\ No newline at end of file
+    return selected_foods, (current_protein, current_carbs, current_fat, current_cals)
+
+
+def find_optimal_foods_balanced_numpy(target_protein, target_carbs, target_fat, target_cals, matrix, max_items=5):
+    """find_optimal_foods_balanced over a MacroMatrix, classifying and scoring with array ops"""
+    targets = (target_protein, target_carbs, target_fat, target_cals)
+    selected_foods = []
+    current = [0, 0, 0, 0]
+
+    def add(food):
+        selected_foods.append(food)
+        current[0] += food.protein
+        current[1] += food.carbs
+        current[2] += food.fat
+        current[3] += food.cals
+
+    protein, carbs, fat, cals = matrix.macros.T
+    
+    # Classify foods using the same heuristics as the Python engine
+    protein_ratio = np.where(cals > 0, protein / np.maximum(cals, 1), 0)
+    candidates = ~matrix.sauce
+    main_mask = candidates & ((protein >= 15) | (cals >= 200) | (protein_ratio >= 0.15))
+    vegetable_mask = candidates & ~main_mask & matrix.vegetable
+    main_dishes = np.flatnonzero(main_mask)
+    vegetables = np.flatnonzero(vegetable_mask)
+    sides = np.flatnonzero(candidates & ~main_mask & ~vegetable_mask)
+    chosen = []
+    
+    # Step 1: Pick the best main dish
+    if len(main_dishes):
+        main_protein = protein[main_dishes]
+        protein_score = np.minimum(main_protein / max(target_protein * 0.6, 1), 1.0) * 100
+        score = protein_score + main_protein / np.maximum(cals[main_dishes], 1) * 30
+        score[np.isnan(score)] = -np.inf
+        best = int(np.argmax(score))
+        if score[best] > -np.inf:
+            chosen.append(main_dishes[best])
+            add(matrix.foods[main_dishes[best]])
+    
+    # Step 2: Add 1-2 vegetables for balance, highest carbs first
+    vegetables_added = 0
+    by_carbs = vegetables[np.argsort(-carbs[vegetables], kind='stable')]
+    for index in by_carbs[:3]:
+        if vegetables_added < 2 and len(selected_foods) < max_items:
+            chosen.append(index)
+            add(matrix.foods[index])
+            vegetables_added += 1
+    
+    # Step 3: Fill remaining with best options
+    order = np.concatenate([sides, main_dishes, vegetables])
+    remaining_foods = matrix.subset(order[~np.isin(order, chosen)])
+    
+    for _ in range(max_items - len(selected_foods)):
+        vegetable_bonus = -20 if vegetables_added < 2 else 0
+        index = remaining_foods.best(targets, current, vegetable_bonus)
+        if index is None:
+            break
+        
+        best_food = remaining_foods.take(index)
+        add(best_food)
+        if remaining_foods.vegetable[index]:
+            vegetables_added += 1
+    
+    return selected_foods, tuple(current)
+
+EXACT_DEADLINE_MS = float(os.getenv("EXACT_DEADLINE_MS", 250))
+
+def find_optimal_foods_exact(target_protein, target_carbs, target_fat, target_cals, food_items, max_items=5, deadline_ms=None):
+    """
+    Best combination of at most max_items foods by calculate_distance, using branch-and-bound.
+
+    The search is seeded with the greedy and balanced picks and stops at
+    deadline_ms (EXACT_DEADLINE_MS by default), returning the best combination
+    found so far. The bounds assume non-negative macros, which labels are.
+    """
+    deadline = time.perf_counter() + (EXACT_DEADLINE_MS if deadline_ms is None else deadline_ms) / 1000
+    matrix = as_matrix(food_items)
+    matrix = matrix.subset(~matrix.sauce)
+    targets = np.array([target_protein, target_carbs, target_fat, target_cals], dtype=np.float64)
+    
+    # Cheapest foods first, so the calorie overshoot bound grows along each branch
+    order = np.argsort(matrix.macros[:, 3], kind='stable')
+    macros = matrix.macros[order]
+    foods = matrix.foods[order]
+    n = len(foods)
+    # suffix_max[i] is the largest value of each macro among foods[i:]
+    suffix_max = np.zeros((n + 1, 4))
+    if n:
+        suffix_max[:n] = np.maximum.accumulate(np.maximum(macros, 0)[::-1], axis=0)[::-1]
+    
+    best_foods = []
+    best_distance = calculate_distance(target_protein, target_carbs, target_fat, target_cals, 0, 0, 0, 0)
+    for heuristic in (find_optimal_foods_balanced, find_optimal_foods_greedy):
+        selected, totals = heuristic(target_protein, target_carbs, target_fat, target_cals, matrix, max_items=max_items)
+        distance = calculate_distance(target_protein, target_carbs, target_fat, target_cals, *totals)
+        if distance < best_distance:
+            best_distance = distance
+            best_foods = list(selected)
+    
+    def search(start, current, count, chosen):
+        nonlocal best_distance, best_foods
+        if count >= max_items or start >= n or time.perf_counter() > deadline:
+            return
+        
+        totals = current + macros[start:]
+        distance = np.abs(targets - totals).sum(axis=1)
+        best_child = int(np.argmin(distance))
+        if distance[best_child] < best_distance:
+            best_distance = float(distance[best_child])
+            best_foods = [foods[i] for i in chosen] + [foods[start + best_child]]
+        
+        slots = max_items - count - 1
+        if slots == 0:
+            return
+        
+        # Overshoot can only grow, and a shortfall can shrink by at most
+        # slots times the largest value still on the menu
+        overshoot = np.maximum(totals - targets, 0).sum(axis=1)
+        shortfall = np.maximum(targets - totals - slots * suffix_max[start + 1:], 0).sum(axis=1)
+        bound = overshoot + shortfall
+        
+        for child in np.argsort(bound, kind='stable'):
+            if bound[child] >= best_distance or time.perf_counter() > deadline:
+                break
+            search(start + child + 1, totals[child], count + 1, chosen + [start + child])
+    
+    search(0, np.zeros(4), 0, [])
+    
+    totals = (sum(food.protein for food in best_foods), sum(food.carbs for food in best_foods),
+              sum(food.fat for food in best_foods), sum(food.cals for food in best_foods))
+    return best_foods, totals
+
+# Optimizers a request can pick by name
+OPTIMIZERS = {
+    "balanced": find_optimal_foods_balanced,
+    "greedy": find_optimal_foods_greedy,
+    "exact": find_optimal_foods_exact,
+}
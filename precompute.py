@@ -0,0 +1,122 @@
+"""
+Precompute recommendations for the most common diet profiles into recommendation_grid.
+
+A profile is a diet/allergen filter (the trait masks compile_plans reduces a
+user's plans to) plus a target bucket from grid.target_bucket. The most common
+profiles among users are solved for every hall and meal of the coming days, so
+/recommend and /recommend_mean answer those users with a lookup instead of a
+solve. Everyone else is still solved live.
+
+Run after each menu ingestion, then hit /menus/invalidate so servers reload
+the grid:
+
+    python precompute.py --days 7 --filters 10 --buckets 30 --optimizer balanced
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from sqlalchemy import delete, select
+
+import schema
+from database import AsyncSessionLocal, async_engine
+from grid import encode_result, target_bucket
+from menu_cache import DINING_HALLS, MEAL_TIMES, filter_foods, get_menu_snapshots, meal_target_time
+from optimize import OPTIMIZERS
+from solver import shutdown_executor, solve
+from traits import compile_plans
+
+async def common_profiles(db, filters, buckets):
+    """[(plans, [bucket, ...])] for the `filters` most common diet filters and each one's `buckets` most common targets"""
+    users = (await db.execute(select(schema.User).where(
+        schema.User.protein.is_not(None),
+        schema.User.carbs.is_not(None),
+        schema.User.fat.is_not(None),
+        schema.User.cals.is_not(None),
+    ))).scalars().all()
+
+    masks = Counter()
+    plans_for = {}
+    targets = {}
+    for user in users:
+        mask = compile_plans(user.plans or [])
+        masks[mask] += 1
+        plans_for.setdefault(mask, user.plans or [])
+        targets.setdefault(mask, Counter())[target_bucket(user.protein, user.carbs, user.fat, user.cals)] += 1
+
+    return [
+        (plans_for[mask], [bucket for bucket, _ in targets[mask].most_common(buckets)])
+        for mask, _ in masks.most_common(filters)
+    ]
+
+async def solve_meal(db, target_time, profiles, optimizer):
+    """GridCell rows for every hall and profile at target_time, plus the seconds spent loading and solving"""
+    start = time.perf_counter()
+    snapshots = await get_menu_snapshots(db, DINING_HALLS, target_time)
+    loaded = time.perf_counter()
+
+    cells = []
+    solves = []
+    for hall, snapshot in snapshots.items():
+        for plans, buckets in profiles:
+            # Filtered once per hall and diet, shared by every bucket
+            foods = filter_foods(snapshot, plans)
+            include, exclude = compile_plans(plans)
+            for bucket in buckets:
+                cells.append((hall, include, exclude, bucket))
+                solves.append(solve(tuple(value / 3 for value in bucket), foods, OPTIMIZERS[optimizer]))
+
+    rows = []
+    for (hall, include, exclude, bucket), (selected, totals, _) in zip(cells, await asyncio.gather(*solves)):
+        protein, carbs, fat, cals = bucket
+        rows.append(schema.GridCell(
+            target_time=target_time, hall=hall, optimizer=optimizer, include_mask=include, exclude_mask=exclude,
+            protein=protein, carbs=carbs, fat=fat, cals=cals, result=encode_result(selected, totals),
+        ))
+    return rows, loaded - start, time.perf_counter() - loaded
+
+async def main(args):
+    async with async_engine.begin() as conn:
+        await conn.run_sync(schema.GridCell.__table__.create, checkfirst=True)
+
+    timings = Counter()
+    cells = 0
+    start = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        profiles = await common_profiles(db, args.filters, args.buckets)
+        timings["profiles"] = time.perf_counter() - start
+        print(f"{len(profiles)} diet filters, {sum(len(buckets) for _, buckets in profiles)} profiles")
+
+        for day in range(args.days):
+            for meal_type in MEAL_TIMES:
+                target_time = meal_target_time(day, meal_type)
+                rows, load_s, solve_s = await solve_meal(db, target_time, profiles, args.optimizer)
+                timings["load"] += load_s
+                timings["solve"] += solve_s
+
+                write_start = time.perf_counter()
+                await db.execute(delete(schema.GridCell).where(
+                    schema.GridCell.target_time == target_time,
+                    schema.GridCell.optimizer == args.optimizer,
+                ))
+                db.add_all(rows)
+                await db.commit()
+                timings["write"] += time.perf_counter() - write_start
+                cells += len(rows)
+
+    elapsed = time.perf_counter() - start
+    shutdown_executor()
+    await async_engine.dispose()
+
+    print(f"{cells} cells in {elapsed:.1f}s ({cells / elapsed if elapsed else 0:.0f} cells/s)")
+    for step in ("profiles", "load", "solve", "write"):
+        print(f"  {step:<9}{timings[step]:8.2f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--filters", type=int, default=10, help="most common diet/allergen filters to cover")
+    parser.add_argument("--buckets", type=int, default=30, help="most common target buckets per filter")
+    parser.add_argument("--optimizer", choices=sorted(OPTIMIZERS), default="balanced")
+    asyncio.run(main(parser.parse_args()))
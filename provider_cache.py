@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+
+from google.genai import types
+
+from caching import TTLCache
+from menu_context import CHARS_PER_TOKEN
+from stream_cache import content_key
+
+logger = logging.getLogger(__name__)
+
+# Gemini won't cache prefixes shorter than this (1024 tokens for flash models)
+PROVIDER_CACHE_MIN_TOKENS = int(os.getenv("PROVIDER_CACHE_MIN_TOKENS", 1024))
+# Upper bound on how long a prefix stays cached upstream, storage is billed per hour
+PROVIDER_CACHE_TTL = float(os.getenv("PROVIDER_CACHE_TTL", 3600))
+# Stop using a cached context this many seconds before the provider drops it
+PROVIDER_CACHE_MARGIN = 60
+# How long to wait before retrying a prefix the provider refused to cache
+PROVIDER_CACHE_RETRY = 300
+
+class GeminiContextProvider:
+    """
+    Creates cached contexts with Gemini's cachedContents API.
+
+    Anything with the same async create() can stand in for it, which is how
+    tests run without an API key.
+    """
+
+    def __init__(self, get_client):
+        self.get_client = get_client
+
+    async def create(self, model, config, contents, ttl):
+        """Cache the system instruction and tools of config plus contents for ttl seconds, returning the cache's name"""
+        cached = await self.get_client().aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=contents,
+                system_instruction=config.system_instruction,
+                tools=config.tools,
+                ttl=f"{int(ttl)}s",
+            ),
+        )
+        return cached.name
+
+class ProviderContexts(TTLCache):
+    """
+    Names of prompt prefixes cached with the model provider, so requests send only what follows them.
+
+    One context is created per distinct prefix, concurrent requests for the
+    same prefix wait on the same creation. Entries expire locally
+    PROVIDER_CACHE_MARGIN seconds before the provider drops them. Prefixes
+    the provider refuses are remembered as None for PROVIDER_CACHE_RETRY
+    seconds so every request doesn't retry them.
+    """
+
+    def __init__(self, name, provider, maxsize=256):
+        super().__init__(name, maxsize, PROVIDER_CACHE_TTL)
+        self.provider = provider
+        self.created = 0
+        self.failures = 0
+        self._creating = {}
+
+    def prefix_key(self, model, config, contents):
+        instruction = [part.text for part in config.system_instruction or []]
+        text = [part.text for content in contents for part in content.parts]
+        return content_key(model, instruction, text)
+
+    async def lookup(self, model, config, contents, ttl=None):
+        """
+        Name of the cached context for config's system instruction and tools plus contents, or None to send them in full.
+
+        Args:
+            ttl: Seconds the context needs to live, capped at PROVIDER_CACHE_TTL
+        """
+        ttl = min(self.ttl, ttl if ttl is not None else self.ttl)
+        characters = sum(len(part.text or "") for content in contents for part in content.parts)
+        if characters / CHARS_PER_TOKEN < PROVIDER_CACHE_MIN_TOKENS or ttl <= PROVIDER_CACHE_MARGIN:
+            return None
+
+        key = self.prefix_key(model, config, contents)
+        missing = object()
+        name = self.get(key, missing)
+        if name is not missing:
+            return name
+
+        creating = self._creating.get(key)
+        if creating is None:
+            creating = asyncio.ensure_future(self._create(key, model, config, contents, ttl))
+            self._creating[key] = creating
+        return await asyncio.shield(creating)
+
+    async def _create(self, key, model, config, contents, ttl):
+        try:
+            name = await self.provider.create(model, config, contents, ttl)
+            self.created += 1
+            self.set(key, name, ttl - PROVIDER_CACHE_MARGIN)
+            return name
+        except Exception as e:
+            self.failures += 1
+            logger.warning("Caching a %s prompt prefix failed, sending it in full: %s", model, e)
+            self.set(key, None, PROVIDER_CACHE_RETRY)
+            return None
+        finally:
+            self._creating.pop(key, None)
+
+    def expire(self, model, config, contents):
+        """Forget the context for this prefix, e.g. when the provider says it's gone"""
+        key = self.prefix_key(model, config, contents)
+        return self.invalidate(lambda cached: cached == key)
+
+    def stats(self):
+        stats = super().stats()
+        stats["created"] = self.created
+        stats["failures"] = self.failures
+        return stats
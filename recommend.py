@@ -0,0 +1,72 @@
+import os
+
+from caching import SingleFlight
+from database import AsyncSessionLocal
+from grid import get_grids, grid_lookup
+from menu_cache import get_menu_snapshot, get_menu_snapshot_range, get_menu_snapshots, filter_foods, menu_version
+from optimize import OPTIMIZERS
+from solver import solve, solve_halls
+from traits import compile_plans
+
+# Everyone asking for the same menus with the same targets and diet at once shares one computation
+coalescer = SingleFlight("recommendation_coalescing")
+
+# Meals of a batch solved at once, each one already spreads its halls over the optimizer pool
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+# Most days one batch may cover
+BATCH_MAX_DAYS = int(os.getenv("BATCH_MAX_DAYS", 14))
+
+def meal_targets(user):
+    """(protein, carbs, fat, cals) for one meal, a third of the user's daily macros"""
+    return (user.protein / 3, user.carbs / 3, user.fat / 3, user.cals / 3)
+
+def computation_key(user, halls, target_time, optimizer):
+    """Two requests with equal keys get the same answer. Plans are reduced to the trait masks they filter on"""
+    return (meal_targets(user), compile_plans(user.plans), halls, target_time, optimizer, menu_version())
+
+async def solve_menu(user, hall, target_time, optimizer):
+    """(selected, totals, solve ms) for one hall's menu at target_time, from the grid when it has the cell"""
+    async def compute():
+        # Its own session, the request that started the computation may be gone before the ones sharing it
+        async with AsyncSessionLocal() as db:
+            cells = await grid_lookup(db, user, (hall,), target_time, optimizer)
+            if hall in cells:
+                selected, totals = cells[hall]
+                return selected, totals, 0.0
+            snapshot = await get_menu_snapshot(db, hall, target_time)
+        return await solve(meal_targets(user), filter_foods(snapshot, user.plans), OPTIMIZERS[optimizer])
+
+    return await coalescer.run(computation_key(user, hall, target_time, optimizer), compute)
+
+async def solve_menus(user, halls, target_time, optimizer):
+    """
+    solve_halls over every hall's menu at target_time, returning (results, timings).
+
+    Halls with a precomputed grid cell for the user are answered from it with
+    a timing of 0, only the rest are solved.
+    """
+    halls = tuple(halls)
+
+    async def compute():
+        async with AsyncSessionLocal() as db:
+            results = await grid_lookup(db, user, halls, target_time, optimizer)
+            missing = [hall for hall in halls if hall not in results]
+            timings = {hall: 0.0 for hall in results}
+            if not missing:
+                return results, timings
+            snapshots = await get_menu_snapshots(db, missing, target_time)
+
+        solved, solve_timings = await solve_halls(
+            meal_targets(user), {hall: filter_foods(snapshot, user.plans) for hall, snapshot in snapshots.items()},
+            OPTIMIZERS[optimizer]
+        )
+        results.update(solved)
+        timings.update(solve_timings)
+        return {hall: results[hall] for hall in halls if hall in results}, {hall: timings[hall] for hall in halls}
+
+    return await coalescer.run(computation_key(user, halls, target_time, optimizer), compute)
+
+async def prefetch_meals(db, halls, target_times):
+    """Load the snapshots and grid cells for many meals with one query each, so solving them only hits caches"""
+    await get_grids(db, target_times)
+    await get_menu_snapshot_range(db, halls, target_times)
@@ -0,0 +1,29 @@
+import os
+
+from caching import TTLCache
+from menu_cache import menu_version
+
+# Finished /recommend and /recommend_mean responses. They last as long as the
+# snapshots they came from, and a menu invalidation changes the key they're under
+result_cache = TTLCache(
+    "recommendations",
+    maxsize=int(os.getenv("RESULT_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("MENU_CACHE_TTL", 3600)),
+)
+
+def result_key(user, endpoint, hall, target_time, optimizer):
+    """Everything a recommendation depends on, user id first so invalidate_user can find them"""
+    return (
+        user.id,
+        endpoint,
+        (user.protein, user.carbs, user.fat, user.cals),
+        tuple(sorted(user.plans or [])),
+        hall,
+        target_time,
+        optimizer,
+        menu_version(),
+    )
+
+def invalidate_user(user_id):
+    """Forget a user's results, e.g. after their macros or plans change"""
+    return result_cache.invalidate(lambda key: key[0] == user_id)
@@ -1,7 +1,8 @@
 from database import Base
-from sqlalchemy import Column, Integer, String, Boolean, text, ARRAY, TIMESTAMP, Float
+from sqlalchemy import Column, Integer, String, Boolean, text, ARRAY, TIMESTAMP, Float, Index, event, inspect
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Literal
+from optimize import nutrition_columns
 
 class User(Base):
     __tablename__ = "Users"
@@ -16,6 +17,11 @@ class User(Base):
 
 class Menu(Base):
     __tablename__ = "menus"
+    __table_args__ = (
+        # Every recommendation filters on hall and meal time then joins on item_id,
+        # so the join can be answered from the index alone
+        Index("ix_menus_location_window", "location", "start_time", "end_time", "item_id"),
+    )
 
     id = Column(Integer,primary_key=True)
     location = Column(String,nullable=False)
@@ -26,6 +32,10 @@ class Menu(Base):
 
 class Food(Base):
     __tablename__ = "foods"
+    __table_args__ = (
+        # Serves traits.contains([...]) / && lookups, `= ANY(traits)` can't use it
+        Index("ix_foods_traits", "traits", postgresql_using="gin"),
+    )
 
     id = Column(String,primary_key=True,nullable=False)
     name = Column(String,nullable=True)
@@ -36,6 +46,56 @@ class Food(Base):
     food_group = Column(ARRAY(String),nullable=True)
     food_type = Column(ARRAY(String),nullable=True)
 
+    # Decoded from nutrition on write, see sync_nutrition_columns and migrate.py
+    calories = Column(Float,nullable=True)
+    protein = Column(Float,nullable=True)
+    carbs = Column(Float,nullable=True)
+    fat = Column(Float,nullable=True)
+    saturated_fat = Column(Float,nullable=True)
+    trans_fat = Column(Float,nullable=True)
+    cholesterol = Column(Float,nullable=True)
+    sodium = Column(Float,nullable=True)
+    sugar = Column(Float,nullable=True)
+    added_sugar = Column(Float,nullable=True)
+    fiber = Column(Float,nullable=True)
+    calcium = Column(Float,nullable=True)
+    iron = Column(Float,nullable=True)
+    # md5 of the nutrition text the columns above were decoded from, stale when it no longer matches
+    nutrition_hash = Column(String,nullable=True)
+
+@event.listens_for(Food, "before_insert")
+def sync_nutrition_columns(mapper, connection, target):
+    for column, value in nutrition_columns(target.nutrition).items():
+        setattr(target, column, value)
+
+@event.listens_for(Food, "before_update")
+def resync_nutrition_columns(mapper, connection, target):
+    if inspect(target).attrs.nutrition.history.has_changes():
+        sync_nutrition_columns(mapper, connection, target)
+
+class GridCell(Base):
+    """One recommendation solved ahead of time by precompute.py, see grid.py"""
+    __tablename__ = "recommendation_grid"
+    __table_args__ = (
+        # The server loads a whole meal's cells at once
+        Index("ix_recommendation_grid_target_time", "target_time"),
+    )
+
+    id = Column(Integer,primary_key=True)
+    target_time = Column(TIMESTAMP,nullable=False)
+    hall = Column(String,nullable=False)
+    optimizer = Column(String,nullable=False)
+    include_mask = Column(Integer,nullable=False)
+    exclude_mask = Column(Integer,nullable=False)
+    # Daily targets at the center of the bucket
+    protein = Column(Float,nullable=False)
+    carbs = Column(Float,nullable=False)
+    fat = Column(Float,nullable=False)
+    cals = Column(Float,nullable=False)
+    # {"foods": [[name, protein, carbs, fat, cals], ...], "totals": [protein, carbs, fat, cals]}
+    result = Column(String,nullable=False)
+    computed_at = Column(TIMESTAMP,server_default=text("now()"))
+
 class GetMealRequest(BaseModel):
 
     fat: float
@@ -68,3 +128,12 @@ class RecommendRequest(BaseModel):
     day: int
     hall: str
     meal_type: str
+    # "exact" searches for the best combination within EXACT_DEADLINE_MS
+    optimizer: Literal["balanced", "greedy", "exact"] = "balanced"
+
+class WeekPlanRequest(BaseModel):
+    start_day: int = 0
+    days: int = 7
+    # Every meal when left out
+    meal_types: Optional[List[str]] = None
+    optimizer: Literal["balanced", "greedy", "exact"] = "balanced"
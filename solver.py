@@ -0,0 +1,71 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from optimize import find_optimal_foods_balanced
+
+# "thread" keeps the event loop free, "process" also spreads solves across cores
+OPTIMIZER_POOL = os.getenv("OPTIMIZER_POOL", "thread")
+OPTIMIZER_WORKERS = int(os.getenv("OPTIMIZER_WORKERS", os.cpu_count() or 4))
+HALL_SOLVE_TIMEOUT_MS = float(os.getenv("HALL_SOLVE_TIMEOUT_MS", 2000))
+
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        if OPTIMIZER_POOL == "process":
+            _executor = ProcessPoolExecutor(max_workers=OPTIMIZER_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=OPTIMIZER_WORKERS, thread_name_prefix="optimizer")
+    return _executor
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def timed_solve(optimizer, targets, foods):
+    """Run optimizer on foods, returning (selected, totals, elapsed ms). Lives at module level so it pickles"""
+    start = time.perf_counter()
+    selected, totals = optimizer(*targets, foods)
+    return selected, totals, (time.perf_counter() - start) * 1000
+
+async def solve(targets, foods, optimizer=find_optimal_foods_balanced):
+    """Solve one menu off the event loop. targets is (protein, carbs, fat, cals)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), timed_solve, optimizer, targets, foods)
+
+async def solve_halls(targets, foods_by_hall, optimizer=find_optimal_foods_balanced, timeout_ms=None):
+    """
+    Solve every hall concurrently, each under its own time budget.
+
+    Returns:
+        (results, timings) where results maps hall to (selected, totals) for the
+        halls that finished in time and timings maps every hall to its solve
+        time in ms, or None if it ran out of time.
+    """
+    timeout = (HALL_SOLVE_TIMEOUT_MS if timeout_ms is None else timeout_ms) / 1000
+
+    async def run(foods):
+        return await asyncio.wait_for(solve(targets, foods, optimizer), timeout)
+
+    halls = list(foods_by_hall)
+    outcomes = await asyncio.gather(*(run(foods_by_hall[hall]) for hall in halls), return_exceptions=True)
+
+    results = {}
+    timings = {}
+    for hall, outcome in zip(halls, outcomes):
+        if isinstance(outcome, asyncio.TimeoutError):
+            # A thread can't be interrupted, the solve finishes in the background and is dropped
+            timings[hall] = None
+            continue
+        if isinstance(outcome, BaseException):
+            raise outcome
+        selected, totals, elapsed_ms = outcome
+        results[hall] = (selected, totals)
+        timings[hall] = round(elapsed_ms, 2)
+
+    return results, timings
@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import json
+
+from caching import TTLCache
+
+def content_key(*parts):
+    """sha256 over the JSON of parts, so equal inputs always land on the same entry"""
+    encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+class SharedStream:
+    """One upstream generation that any number of readers follow, each from the first chunk"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.task = None
+        self._changed = asyncio.Condition()
+
+    async def produce(self, source):
+        try:
+            async for text in source:
+                self.chunks.append(text)
+                async with self._changed:
+                    self._changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def read(self):
+        sent = 0
+        while True:
+            while sent < len(self.chunks):
+                yield self.chunks[sent]
+                sent += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            async with self._changed:
+                await self._changed.wait_for(lambda: self.done or sent < len(self.chunks))
+
+class StreamCache(TTLCache):
+    """
+    TTLCache of finished text streams with single-flight generation.
+
+    A hit replays the stored chunks straight away. A miss joins the generation
+    already running for the key, or starts one. Generations run as their own
+    task, so a reader disconnecting doesn't cut the stream off for the others,
+    and only streams that finish without an error are stored.
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        super().__init__(name, maxsize, ttl)
+        self.coalesced = 0
+        self._inflight = {}
+
+    async def stream(self, key, source, ttl=None):
+        """
+        Chunks for key, taken from the cache or from source().
+
+        Args:
+            source: Zero argument callable returning the async iterator of
+                chunks to use when nothing is cached or in flight for key
+            ttl: Seconds to keep the finished stream for, defaults to the cache's ttl
+        """
+        chunks = self.get(key)
+        if chunks is not None:
+            for text in chunks:
+                yield text
+            return
+
+        shared = self._inflight.get(key)
+        if shared is None:
+            shared = SharedStream()
+            self._inflight[key] = shared
+            shared.task = asyncio.create_task(self._generate(key, shared, source(), ttl))
+        else:
+            self.coalesced += 1
+
+        async for text in shared.read():
+            yield text
+
+    async def _generate(self, key, shared, source, ttl):
+        try:
+            await shared.produce(source)
+            if shared.error is None:
+                self.set(key, tuple(shared.chunks), ttl)
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        stats = super().stats()
+        stats["inflight"] = len(self._inflight)
+        stats["coalesced"] = self.coalesced
+        return stats
@@ -0,0 +1,47 @@
+# The one place that maps a User.plans entry to a food trait:
+# plan -> (trait, whether the food must have it or must not have it)
+PLAN_TRAITS = {
+    "Vegan": ("Vegan", True),
+    "Vegetarian": ("Vegetarian", True),
+    "Peanuts": ("Peanuts", False),
+    "Dairy": ("Milk", False),
+    "Eggs": ("Eggs", False),
+    "Fish": ("Fish", False),
+    "Shellfish": ("Shellfish", False),
+    "Soy": ("Soy", False),
+    "Gluten": ("Gluten", False),
+}
+
+# Only traits some plan refers to get a bit, everything else can't affect filtering
+TRAIT_BITS = {trait: 1 << bit for bit, trait in enumerate(sorted({trait for trait, _ in PLAN_TRAITS.values()}))}
+
+# Set for foods whose traits are NULL, they fail every plan like traits.any() on NULL did in SQL
+UNKNOWN_TRAITS = 1 << len(TRAIT_BITS)
+
+def encode_traits(traits):
+    """Bitmask of a Food.traits array"""
+    if traits is None:
+        return UNKNOWN_TRAITS
+    mask = 0
+    for trait in traits:
+        mask |= TRAIT_BITS.get(trait, 0)
+    return mask
+
+def compile_plans(plans):
+    """(include, exclude) masks for a User.plans list"""
+    include = exclude = 0
+    for plan in plans or []:
+        if plan not in PLAN_TRAITS:
+            continue
+        trait, required = PLAN_TRAITS[plan]
+        if required:
+            include |= TRAIT_BITS[trait]
+        else:
+            exclude |= TRAIT_BITS[trait]
+    if include or exclude:
+        exclude |= UNKNOWN_TRAITS
+    return include, exclude
+
+def matching(masks, include, exclude):
+    """Boolean array of which trait masks have every include bit and no exclude bit"""
+    return ((masks & include) == include) & ((masks & exclude) == 0)
@@ -0,0 +1,64 @@
+import os
+
+from fastapi import HTTPException
+from starlette import status
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+# Hard cap on an upload's request body, checked against Content-Length and then while it streams in
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 15 * 1024 * 1024))
+
+def upload_openapi(field):
+    """openapi_extra describing a single file field, for endpoints that parse their own multipart body"""
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "required": [field],
+        "properties": {field: {"type": "string", "format": "binary"}},
+    }}}}}
+
+def too_large():
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Upload is larger than {MAX_UPLOAD_BYTES / 2**20:.1f} MB",
+    )
+
+async def bounded_stream(request, max_bytes):
+    """The request body, raising 413 as soon as more than max_bytes have arrived"""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise too_large()
+        yield chunk
+
+async def read_upload(request, field, max_bytes=None):
+    """
+    The file sent as `field` in a multipart request, without ever holding the whole body in memory.
+
+    Bodies whose Content-Length is over the limit are refused before any of
+    it is read, the rest are parsed as they stream in and cut off at the
+    limit. The file part spools to disk past 1 MB, so the caller gets a
+    seekable file whatever the upload's size.
+
+    Raises:
+        HTTPException: 413 if the body is over max_bytes (default MAX_UPLOAD_BYTES),
+            400 if it isn't multipart or has no file under `field`
+    """
+    max_bytes = MAX_UPLOAD_BYTES if max_bytes is None else max_bytes
+
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        raise too_large()
+
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected a multipart/form-data upload")
+
+    try:
+        form = await MultiPartParser(request.headers, bounded_stream(request, max_bytes), max_files=1, max_fields=10).parse()
+    except MultiPartException as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e.message)
+
+    upload = form.get(field)
+    if not isinstance(upload, UploadFile):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"No file sent as '{field}'")
+    return upload
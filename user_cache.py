@@ -0,0 +1,50 @@
+import os
+
+import schema
+from caching import TTLCache
+
+# Profiles the recommendation handlers read, kept current by the update handlers.
+# Each worker process has its own, so another worker's update can take up to the TTL to show up
+profile_cache = TTLCache(
+    "user_profiles",
+    maxsize=int(os.getenv("USER_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("USER_CACHE_TTL", 300)),
+)
+
+class UserProfile:
+    """The parts of a User the handlers need, detached from any session"""
+
+    def __init__(self, id, protein, carbs, fat, cals, plans):
+        self.id = id
+        self.protein = protein
+        self.carbs = carbs
+        self.fat = fat
+        self.cals = cals
+        self.plans = tuple(plans or ())
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.protein, user.carbs, user.fat, user.cals, user.plans)
+
+    def __repr__(self):
+        return f"UserProfile({self.id}, {self.protein}/{self.carbs}/{self.fat}/{self.cals}, {list(self.plans)})"
+
+async def get_profile(db, user_id):
+    """A user's profile, from the cache or from Users if it isn't there. None if the user doesn't exist"""
+    profile = profile_cache.get(user_id)
+    if profile is not None:
+        return profile
+
+    user = await db.get(schema.User, user_id)
+    if user is None:
+        return None
+    if user.plans is None:
+        user.plans = []
+        await db.commit()
+    return store_profile(user)
+
+def store_profile(user):
+    """Write a just-committed User through to the cache"""
+    profile = UserProfile.from_user(user)
+    profile_cache.set(profile.id, profile)
+    return profile